@@ -0,0 +1,343 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of the selectorstring directives and clusters at scale.
+
+   Run from a buildout with the test eggs installed::
+
+      bin/zopepy -m tau.selectorstrings.benchmark --clusters=10 --strings=1000 \
+          --output=benchmark-0.2.json
+
+   Synthetic ZCML of N clusters of M selectorstrings each, half declared by
+   the simple directive and half by the complex one, is generated and the
+   configuration process timed with and without the accumulation of
+   selectorstrings into one action per cluster.  Then, for a cluster of M
+   selectorstrings in each storage layout, are timed the lookups by value
+   and by token, the tests of membership and full iteration, and its memory
+   is measured, as is the size of its <option> markup with each kind of
+   token.  Also timed is the vocabulary factory against a registry
+   lookup, and checked is that reader threads see a mutable cluster whole
+   while strings are registered with it at runtime.
+
+   The results may be saved as JSON, so that those of one release can be
+   compared against those of another.
+"""
+import json
+import resource
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from zope.component import queryUtility
+from zope.schema.vocabulary import SimpleTerm
+
+from zope.configuration import xmlconfig
+from zope.testing.cleanup import cleanUp
+
+import tau.selectorstrings
+from .interfaces import IClusterOfSelectors
+from .vocabulary import ClusterVocabularyFactory, provide_cluster
+from .zcml_directives import ACCUMULATE_FEATURE, CLUSTER_STORAGES
+from .zcml_directives import ClusterOfSelectors, ClusterVersion
+
+
+def synthetic_zcml(clusters, strings):
+    """Return ZCML declaring clusters*strings selectorstrings.
+
+       Half of the clusters use the simple directive and half the complex one.
+    """
+
+    lines = ['<configure xmlns="http://namespaces.zope.org/zope">']
+    for c in range(clusters):
+        name = 'cluster%d' % c
+        if c % 2:
+            lines.append('<selectorcluster name="%s">' % name)
+            for s in range(strings):
+                lines.append('<selectorstring label="Path %d" value="/%s/path%d/" />'
+                             % (s, name, s))
+            lines.append('</selectorcluster>')
+        else:
+            for s in range(strings):
+                lines.append('<selectorstring cluster="%s" label="Path %d" value="/%s/path%d/" />'
+                             % (name, s, name, s))
+    lines.append('</configure>')
+    return '\n'.join(lines)
+
+
+def synthetic_cluster(storage, strings, tokens='value'):
+    """Return a frozen cluster of synthetic path selectorstrings.
+    """
+
+    cluster = CLUSTER_STORAGES[storage]('synthetic')
+    cluster.tokens = tokens
+    for s in range(strings):
+        cluster.register(u'/synthetic/path%d/' % s, u'Path %d' % s)
+    cluster.freeze()
+    return cluster
+
+
+def time_configuration(zcml, accumulate=False):
+    """Return the seconds taken to parse and execute some selector ZCML.
+    """
+
+    cleanUp()
+    try:
+        context = xmlconfig.file('meta.zcml', package=tau.selectorstrings, execute=False)
+        if accumulate:
+            context.provideFeature(ACCUMULATE_FEATURE)
+
+        started = time.time()
+        xmlconfig.string(zcml, context=context)
+        return time.time() - started
+    finally:
+        cleanUp()
+
+
+def time_lookups(cluster, repeat=1):
+    """Return the microseconds per lookup/test, and per iteration, of a cluster.
+    """
+
+    terms = list(cluster)
+    values = [term.value for term in terms]
+    tokens = [term.token for term in terms]
+    timings = {}
+
+    for name, call, args in (
+            ('getTerm', cluster.getTerm, values),
+            ('getTermByToken', cluster.getTermByToken, tokens),
+            ('__contains__', cluster.__contains__, values)):
+        started = time.time()
+        for i in range(repeat):
+            for arg in args:
+                call(arg)
+        timings[name] = (time.time() - started) * 1e6 / (repeat * len(args))
+
+    started = time.time()
+    for i in range(repeat):
+        for term in cluster:
+            pass
+    timings['iteration'] = (time.time() - started) * 1e6 / repeat
+
+    return timings
+
+
+def deep_sizeof(obj, seen=None):
+    """Return the bytes held by an object and by the containers/terms within it.
+
+       Only builtin containers, terms and clusters are descended into, so
+       that shared objects such as classes and interfaces are not counted.
+    """
+
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif isinstance(obj, (SimpleTerm, ClusterVersion, ClusterOfSelectors)):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+def time_vocabulary_factories(calls):
+    """Return the microseconds per call of a registry lookup and of our factory.
+    """
+
+    cleanUp()
+    try:
+        cluster = CLUSTER_STORAGES['terms']('factory')
+        provide_cluster(cluster, 'factory')
+
+        def lookup(context): # what each render used to cost
+            return queryUtility(IClusterOfSelectors, name='factory')
+        factory = ClusterVocabularyFactory('factory')
+
+        timings = []
+        for vocabulary_factory in (lookup, factory):
+            started = time.time()
+            for i in range(calls):
+                vocabulary_factory(None)
+            timings.append((time.time() - started) * 1e6 / calls)
+        return timings
+    finally:
+        cleanUp()
+
+
+def stress_registration(storage, readers=8, strings=2000):
+    """Return the inconsistencies seen by reader threads during registration.
+
+       A mutable, frozen, cluster has strings registered with it by one
+       thread while others repeatedly iterate over it and look up each term
+       they find by value and by token.  Every version a reader sees should
+       be whole, and no smaller than the one it saw before.
+    """
+
+    cluster = CLUSTER_STORAGES[storage]('stress')
+    cluster.mutable = True
+    cluster.freeze()
+
+    done = threading.Event()
+    failures = []
+
+    def read():
+        seen = 0
+        while not done.isSet():
+            terms = list(cluster)
+            if len(terms) < seen:
+                failures.append('shrank from %d to %d terms' % (seen, len(terms)))
+            seen = len(terms)
+            for term in terms:
+                if (term.value not in cluster
+                        or cluster.getTerm(term.value).token != term.token
+                        or cluster.getTermByToken(term.token).value != term.value):
+                    failures.append('inconsistent term %r' % (term,))
+            options = cluster.renderOptions()
+            if options.count(u'<option') < seen:
+                failures.append('stale options for %d terms' % seen)
+
+    threads = [threading.Thread(target=read) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for s in range(strings):
+            cluster.register(u'/stress/path%d/' % s, u'Path %d' % s)
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    if len(cluster) != strings:
+        failures.append('ended with %d of %d terms' % (len(cluster), strings))
+    return failures
+
+
+def peak_memory():
+    """Return the peak resident memory of this process so far, in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_suite(clusters, strings, repeat=3):
+    """Run every benchmark and return the results as a dictionary.
+    """
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'clusters': clusters,
+        'strings': strings,
+        }
+    try:
+        import pkg_resources
+        results['version'] = pkg_resources.get_distribution('tau.selectorstrings').version
+    except Exception:
+        results['version'] = None
+
+    zcml = synthetic_zcml(clusters, strings)
+    results['configuration'] = {
+        'per_string': time_configuration(zcml, accumulate=False),
+        'per_cluster': time_configuration(zcml, accumulate=True),
+        'peak_memory_kb': peak_memory(),
+        }
+
+    results['storages'] = {}
+    for storage in sorted(CLUSTER_STORAGES):
+        cluster = synthetic_cluster(storage, strings)
+        memory = deep_sizeof(cluster) # before any terms are cached by lookups
+        timings = time_lookups(cluster, repeat)
+        timings['memory'] = memory
+        results['storages'][storage] = timings
+        del cluster
+
+    results['options_bytes'] = {}
+    for tokens in ('value', 'digest', 'sequential'):
+        markup = synthetic_cluster('terms', strings, tokens).renderOptions()
+        results['options_bytes'][tokens] = len(markup.encode('utf-8'))
+
+    results['concurrency'] = {}
+    for storage in sorted(CLUSTER_STORAGES):
+        started = time.time()
+        failures = stress_registration(storage, strings=min(strings, 500))
+        results['concurrency'][storage] = {
+            'seconds': time.time() - started,
+            'failures': failures[:10],
+            }
+
+    lookup, factory = time_vocabulary_factories(100000)
+    results['vocabulary_factory'] = {'lookup': lookup, 'factory': factory}
+
+    results['peak_memory_kb'] = peak_memory()
+    return results
+
+
+def report(results):
+    print('Configuring %(clusters)d clusters x %(strings)d selectorstrings' % results)
+    configuration = results['configuration']
+    print('  one action per string:  %8.3fs' % configuration['per_string'])
+    print('  one action per cluster: %8.3fs' % configuration['per_cluster'])
+    print('  peak memory:            %8dkB' % configuration['peak_memory_kb'])
+
+    print('One cluster of %(strings)d selectorstrings, in microseconds' % results)
+    print('  %-8s %10s %14s %12s %12s %12s' % (
+        'storage', 'getTerm', 'getTermByToken', '__contains__', 'iteration', 'bytes'))
+    for storage, timings in sorted(results['storages'].items()):
+        print('  %-8s %10.3f %14.3f %12.3f %12.1f %12d' % (
+            storage, timings['getTerm'], timings['getTermByToken'],
+            timings['__contains__'], timings['iteration'], timings['memory']))
+
+    print('Rendered <option> markup, by tokens')
+    for tokens, size in sorted(results['options_bytes'].items()):
+        print('  %-10s %10d bytes' % (tokens, size))
+
+    print('Registering at runtime against 8 reader threads')
+    for storage, stress in sorted(results['concurrency'].items()):
+        print('  %-8s %8.3fs %s' % (storage, stress['seconds'],
+                                   '; '.join(stress['failures']) or 'consistent'))
+
+    print('Vocabulary factory, per call')
+    print('  registry lookup:        %8.3fus' % results['vocabulary_factory']['lookup'])
+    print('  cluster held by factory:%8.3fus' % results['vocabulary_factory']['factory'])
+
+    print('Peak memory: %dkB' % results['peak_memory_kb'])
+
+
+def main(argv=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--clusters', type='int', default=10,
+                      help="the number of clusters to configure [%default]")
+    parser.add_option('--strings', type='int', default=1000,
+                      help="the number of selectorstrings per cluster [%default]")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="the times to repeat each lookup benchmark [%default]")
+    parser.add_option('--output', metavar='FILE',
+                      help="save the results as JSON to FILE")
+    options, args = parser.parse_args(argv)
+
+    results = run_suite(options.clusters, options.strings, options.repeat)
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Sort keys for ordering the strings of a cluster by the rules of a locale.
+
+   Where PyICU is installed, the collator of the named locale is used.
+   Otherwise the sort keys come from locale.strxfrm(), which follows the
+   collation locale of the whole process, whatever locale is named, since
+   changing it would affect every other thread too.
+"""
+import locale
+
+try:
+    import icu
+except ImportError:
+    icu = None
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+_keys = {} # the sort key function by name of locale
+
+
+def _strxfrm(text):
+    try:
+        return locale.strxfrm(text)
+    except UnicodeError: # older Pythons transform only encoded text
+        encoding = locale.getlocale(locale.LC_COLLATE)[1] or 'utf-8'
+        return locale.strxfrm(text.encode(encoding, 'replace'))
+
+
+def collation_key(collation):
+    """Return a function making a sort key of some text for a locale.
+    """
+
+    key = _keys.get(collation)
+    if key is None:
+        if icu is not None:
+            key = icu.Collator.createInstance(icu.Locale(collation)).getSortKey
+        else:
+            log.warning("PyICU is not installed, so strings are collated by the "
+                        "locale of the process rather than by %r" % collation)
+            key = _strxfrm
+        key = _keys.setdefault(collation, key)
+    return key
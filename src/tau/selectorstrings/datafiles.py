@@ -0,0 +1,219 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Readers of external data files holding selectorstrings.
+
+   A cluster of many thousands of strings is painful to declare one ZCML
+   directive at a time, so the <selectorfile> directive points at a data file
+   instead.  The readers here stream such a file, one row at a time, as
+   (value, label) pairs without building the whole file in memory.
+
+   Two formats are understood.  A CSV file holds the value in its first
+   column and an optional label in its second::
+
+      /usr/share/public/,Public Documents
+      /home/jeff/photos/,Family Photos
+
+   A JSON-lines file holds one object per line::
+
+      {"value": "/usr/share/public/", "label": "Public Documents"}
+      {"value": "/home/jeff/photos/"}
+
+   Blank lines are skipped in both formats.  A JSON file instead holds a
+   single array of such objects, which is parsed one object at a time.
+   Values and labels must be strings.
+
+   Many data files can also be read at once, by a pool of threads or of
+   processes, each file into a tuple of its pairs.
+"""
+import csv
+import io
+import json
+import os.path
+import re
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+FORMATS_BY_EXTENSION = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.json': 'json',
+    }
+
+
+def guess_format(path):
+    """Return the data format implied by the extension of a filename, or None.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return FORMATS_BY_EXTENSION.get(extension)
+
+
+def iter_csv_selectors(path):
+    """Generate (value, label) pairs from the rows of a CSV file.
+    """
+    with open(path, 'rb') as f:
+        for lineno, row in enumerate(csv.reader(f), 1):
+            if not row:
+                continue
+            row = [cell.decode('utf-8') for cell in row]
+            value = row[0]
+            label = row[1] if len(row) > 1 and row[1] else None
+            if not value:
+                raise ValueError(
+                    '%s, line %d: a selectorstring requires a value' % (path, lineno))
+            yield value, label
+
+
+text_type = type(u'')
+
+
+def _json_selector(row, where):
+    """Return the (value, label) pair of an object read from JSON.
+    """
+    try:
+        value = row['value']
+        label = row.get('label') or None
+    except (TypeError, KeyError, AttributeError):
+        raise ValueError('%s: expected an object with a "value", got %r' % (where, row))
+    if not value:
+        raise ValueError('%s: a selectorstring requires a value' % where)
+    if not isinstance(value, text_type):
+        raise ValueError('%s: the value must be a string, got %r' % (where, value))
+    if label is not None and not isinstance(label, text_type):
+        raise ValueError('%s: the label must be a string, got %r' % (where, label))
+    return value, label
+
+
+def iter_jsonl_selectors(path):
+    """Generate (value, label) pairs from the lines of a JSON-lines file.
+    """
+    with open(path, 'rb') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            where = '%s, line %d' % (path, lineno)
+            try:
+                row = json.loads(line.decode('utf-8'))
+            except ValueError:
+                raise ValueError('%s: expected an object with a "value", got %r'
+                                 % (where, line))
+            yield _json_selector(row, where)
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+JSON_CHUNK = 65536 # the characters of a JSON file read at a time
+
+
+def iter_json_selectors(path, chunk=JSON_CHUNK):
+    """Generate (value, label) pairs from the array of objects of a JSON file.
+
+       The array is parsed one object at a time, as the file is read in
+       chunks, so that neither the file nor the array is ever held whole.
+    """
+    decoder = json.JSONDecoder()
+    with io.open(path, encoding='utf-8') as f:
+        text = u''
+        position = 0
+        number = 0
+        expected = u'[' # the punctuation that must come next, or None for an object
+        while True:
+            position = JSON_WHITESPACE.match(text, position).end()
+            if position == len(text):
+                text, position = f.read(chunk), 0
+                if not text:
+                    raise ValueError('%s: the JSON array ends too soon' % path)
+                continue
+
+            if expected is None or (expected == u']' and text[position] != u']'):
+                try:
+                    row, end = decoder.raw_decode(text, position)
+                except ValueError as e: # maybe an object cut short by the chunk
+                    more = f.read(chunk)
+                    if not more:
+                        raise ValueError('%s, item %d: not a JSON object (%s)'
+                                         % (path, number + 1, e))
+                    text, position = text[position:] + more, 0
+                    continue
+                number += 1
+                yield _json_selector(row, '%s, item %d' % (path, number))
+                position = end
+                expected = u',]'
+                continue
+
+            if text[position] not in expected:
+                raise ValueError('%s: expected one of %r in the JSON array, got %r'
+                                 % (path, str(expected), text[position:position + 20]))
+            if text[position] == u']':
+                break
+            expected = u']' if text[position] == u'[' else None
+            position += 1
+
+        rest = text[position + 1:] + f.read()
+        if rest.strip():
+            raise ValueError('%s: unexpected %r after the JSON array' % (path, rest.strip()[:20]))
+
+
+READERS = {
+    'csv': iter_csv_selectors,
+    'jsonl': iter_jsonl_selectors,
+    'json': iter_json_selectors,
+    }
+
+
+def iter_selectors(path, format=None):
+    """Generate (value, label) pairs from a data file in the given format.
+
+       If no format is given it is guessed from the extension of the filename.
+    """
+    if format is None:
+        format = guess_format(path)
+    if format not in READERS:
+        raise ValueError('Cannot determine the format of selector file %r' % path)
+    return READERS[format](path)
+
+
+def read_selectors(path, format=None):
+    """Return the (mtime, selectors) of a data file, its pairs read into a tuple.
+
+       The modification time is taken before the file is read, so that any
+       change made while reading it is seen as such by a later reload.
+    """
+    mtime = os.stat(path).st_mtime
+    return mtime, tuple(iter_selectors(path, format))
+
+
+def read_many_selectors(files, workers=8, processes=False):
+    """Read many data files concurrently, given as (path, format) pairs.
+
+       Returns the (mtime, selectors) of each file, in the order given.  The
+       files are read by a pool of threads, which suits files on network
+       filesystems, or of processes, which suits many large files that are
+       costly to parse.
+    """
+    files = list(files)
+    if len(files) < 2 or workers < 2:
+        return [read_selectors(path, format) for path, format in files]
+
+    pool = (Pool if processes else ThreadPool)(min(workers, len(files)))
+    try:
+        results = [pool.apply_async(read_selectors, file) for file in files]
+        read = [result.get() for result in results]
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return read
@@ -0,0 +1,183 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Clusters whose strings are the subdirectories of a directory on disk.
+
+   Rather than keep a list of <selectorstring> directives in step with the
+   directories on disk by hand, a cluster can be declared as the listing of
+   a directory::
+
+      <selectordirectory
+          cluster="sitedocs"
+          directory="/usr/share/sitedocs"
+          pattern="team-*"
+          ttl="60"
+          />
+
+   Each subdirectory matching the pattern becomes a selectorstring, with its
+   full path (ending in a separator) as the value and its name as the label.
+
+   The directory is not listed until the vocabulary is first asked for.  The
+   listing is then kept for ttl seconds, after which the modification time
+   of the directory is checked and, only if it has changed, the directory is
+   listed again.
+"""
+import fnmatch
+import os
+import time
+
+from zope.interface import implements
+from zope.component import queryUtility, provideUtility
+from zope.schema.interfaces import IVocabularyFactory, IVocabularyTokenized
+from zope.configuration.exceptions import ConfigurationError
+
+from .interfaces import IClusterOfSelectors
+from .vocabulary import ClusterVocabularyFactory, provide_cluster
+from .zcml_directives import ClusterOfSelectors, schedule_freeze
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # the backport, for older Pythons
+    except ImportError:
+        scandir = None
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+
+def list_subdirectories(directory, pattern='*'):
+    """Return the sorted names of the subdirectories matching a glob pattern.
+
+       As with a shell glob, names beginning with a dot are only matched by a
+       pattern that does too.
+    """
+
+    if scandir is not None:
+        names = [entry.name for entry in scandir(directory) if entry.is_dir()]
+    else:
+        names = [name for name in os.listdir(directory)
+                 if os.path.isdir(os.path.join(directory, name))]
+
+    if not pattern.startswith('.'):
+        names = [name for name in names if not name.startswith('.')]
+    return sorted(fnmatch.filter(names, pattern))
+
+
+class DirectoryClusterOfSelectors(object):
+    """A cluster of the subdirectories of a directory, listed lazily.
+
+       Each listing of the directory is built into a frozen ClusterOfSelectors
+       of its own, and everything asked of this cluster is answered by the
+       latest of those.  A new listing replaces the old by a single assignment,
+       so that readers never see one half-built nor need to take a lock.
+    """
+    implements(IClusterOfSelectors, IVocabularyTokenized)
+
+    def __init__(self, clustername, directory, pattern='*', ttl=60):
+        self.clustername = clustername
+        self.directory = directory
+        self.pattern = pattern
+        self.ttl = ttl
+        self._listing = None # (cluster, mtime of directory, time to check again)
+
+    def __repr__(self):
+        return "%s(%r, %r, id=%r)" % (
+            self.__class__.__name__, self.clustername, self.directory, id(self))
+
+    def _cluster(self):
+        """Return the cluster of the latest listing, listing again if need be.
+        """
+
+        listing = self._listing
+        now = time.time()
+        if listing is not None and now < listing[2]:
+            return listing[0]
+
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError as e:
+            log.warning("Cannot list directory %r for cluster %r: %s"
+                        % (self.directory, self.clustername, e))
+            mtime = None
+
+        if listing is not None and mtime == listing[1]:
+            cluster = listing[0] # unchanged, so merely check again later
+        else:
+            cluster = ClusterOfSelectors(self.clustername)
+            if mtime is not None:
+                for name in list_subdirectories(self.directory, self.pattern):
+                    cluster.register(os.path.join(self.directory, name, ''), name)
+            cluster.freeze()
+
+        self._listing = (cluster, mtime, now + self.ttl)
+        return cluster
+
+    def refresh(self):
+        """Discard the listing, so that the directory is listed again when next used.
+        """
+        self._listing = None
+
+    def freeze(self):
+        pass # each listing is frozen as it is made
+
+    def register(self, value, label=None):
+        raise ValueError(
+            'Cannot add selector (value=%r, label=%r) to the cluster %r, '
+            'which lists the directory %r.'
+            % (value, label, self.clustername, self.directory))
+
+    def __getattr__(self, name):
+        if name.startswith('__'): # such as __conform__, never to be delegated
+            raise AttributeError(name)
+        return getattr(self._cluster(), name)
+
+    def __iter__(self):
+        return iter(self._cluster())
+
+    def __len__(self):
+        return len(self._cluster())
+
+    def __contains__(self, value):
+        return value in self._cluster()
+
+
+def selectordirectory_SimpleDirectiveHandler(_context, cluster, directory,
+                                             pattern=u'*', ttl=60):
+    """Handler of a simple ZCML directive declaring a cluster of subdirectories.
+    """
+
+    schedule_freeze(_context)
+
+    def deferred__instantiate_directory_cluster(clustername, directory, pattern, ttl):
+        """The actual handling that is performed at the -END- of configuration.
+
+           Create the cluster, without yet listing the directory.
+        """
+
+        if queryUtility(IClusterOfSelectors, name=clustername) is not None:
+            raise ConfigurationError(
+                "The cluster %r, which lists the directory %r, is also "
+                "declared by other directives" % (clustername, directory))
+
+        cluster = DirectoryClusterOfSelectors(clustername, directory, pattern, ttl)
+        provide_cluster(cluster, clustername)
+        provideUtility(ClusterVocabularyFactory(clustername, cluster),
+                       provides=IVocabularyFactory, name=clustername)
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorcluster', cluster),  # must be unique!
+        callable=deferred__instantiate_directory_cluster,
+        args=(cluster, directory, pattern, ttl),
+        )
@@ -0,0 +1,171 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Reloading of clusters whose data files have changed, without a restart.
+
+   A cluster loaded by <selectorfile> directives remembers, for each data
+   file, the run of its strings that came from that file and the time the
+   file was modified.  Reloading a cluster re-reads only those files since
+   modified and builds a whole new cluster, reusing the strings of the
+   others, including any declared in ZCML.
+
+   The new cluster is frozen and only then provided to the registry in place
+   of the old one, whereupon the vocabulary factory of the cluster moves on
+   to it.  Request threads thus see either the old cluster or the new, never
+   one half-built, and take no lock to do so.
+
+   Clusters can be reloaded on demand by calling reload_clusters(), or
+   regularly by a background thread started by the directive::
+
+      <selectorreload interval="30" />
+"""
+import os
+import threading
+
+from zope.component import getUtilitiesFor
+
+from .interfaces import IClusterOfSelectors
+from .datafiles import iter_selectors
+from .vocabulary import provide_cluster
+from .zcml_directives import ClusterOfSelectors, CLUSTER_STORAGES, FREEZE_ORDER
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+
+def changed_sources(cluster):
+    """Return the paths of the data files of a cluster modified since being read.
+    """
+
+    changed = []
+    for path, format, mtime, count in cluster.sources:
+        if path is None:
+            continue
+        try:
+            if os.stat(path).st_mtime != mtime:
+                changed.append(path)
+        except OSError:
+            pass # a vanished file keeps the strings it last had
+    return changed
+
+
+def reloaded_cluster(cluster):
+    """Return a new, frozen, cluster with the changed data files of another re-read.
+    """
+
+    reloaded = type(cluster)(cluster.clustername)
+    for name in cluster.settings:
+        setattr(reloaded, name, getattr(cluster, name))
+    start = 0
+    for path, format, mtime, count in cluster.sources:
+        try:
+            changed = path is not None and os.stat(path).st_mtime != mtime
+        except OSError:
+            changed = False
+
+        if changed:
+            reloaded.extend(iter_selectors(path, format), path, format)
+        else:
+            terms = [cluster._term(position) for position in range(start, start + count)]
+            reloaded.extend([(term.value, term.title) for term in terms],
+                            path, format, mtime)
+        start += count
+
+    # Restrictions and flags go on applying to the values still present,
+    # but the values of the files re-read are not validated again.
+    reloaded._version.predicates = dict(
+        (value, predicate) for value, predicate in cluster._version.predicates.items()
+        if value in reloaded)
+    reloaded.invalid = dict(
+        (value, problem) for value, problem in cluster.invalid.items() if value in reloaded)
+
+    reloaded.freeze()
+    reloaded.mutable = cluster.mutable
+    return reloaded
+
+
+def reload_cluster(clustername, cluster):
+    """Reload one cluster if any of its data files has changed.
+
+       Returns the new cluster, once it is published, or None if unchanged.
+    """
+
+    changed = changed_sources(cluster)
+    if not changed:
+        return None
+
+    log.info("Reloading cluster %r, as %s changed"
+             % (clustername, ', '.join(repr(path) for path in changed)))
+    reloaded = reloaded_cluster(cluster)
+    provide_cluster(reloaded, clustername)
+    return reloaded
+
+
+def reload_clusters():
+    """Reload every cluster having a data file that has changed.
+
+       Returns the names of the clusters reloaded.  A cluster that fails to
+       reload, such as from an error in its data file, is left as it was.
+    """
+
+    reloaded = []
+    for clustername, cluster in list(getUtilitiesFor(IClusterOfSelectors)):
+        if not isinstance(cluster, ClusterOfSelectors):
+            continue # not a cluster loaded from files
+        if cluster.storage not in CLUSTER_STORAGES:
+            continue # such as one moved into shared memory
+        try:
+            if reload_cluster(clustername, cluster) is not None:
+                reloaded.append(clustername)
+        except Exception:
+            log.exception("Failed to reload cluster %r" % clustername)
+    return reloaded
+
+
+class SelectorFileWatcher(threading.Thread):
+    """A background thread that reloads changed clusters every so many seconds.
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name="tau.selectorstrings reloader")
+        self.setDaemon(True)
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.isSet():
+            self.stopping.wait(self.interval)
+            if not self.stopping.isSet():
+                reload_clusters()
+
+    def stop(self):
+        self.stopping.set()
+
+
+def selectorreload_SimpleDirectiveHandler(_context, interval=30):
+    """Handler of a simple ZCML directive starting the reloading of clusters.
+    """
+
+    def deferred__start_watcher(interval):
+        """The actual handling that is performed at the -END- of configuration.
+
+           Start the watching of data files only once all clusters are frozen.
+        """
+        SelectorFileWatcher(interval).start()
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorreload',),  # must be unique!
+        callable=deferred__start_watcher,
+        args=(interval,),
+        order=FREEZE_ORDER + 1,
+        )
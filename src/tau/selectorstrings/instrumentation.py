@@ -0,0 +1,263 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Counting the use of each cluster, and timing it, to find those hot or slow.
+
+   Instrumentation is enabled by the directive::
+
+      <selectorinstrumentation />
+
+   or by calling enable_instrumentation().  Each cluster then counts the
+   calls made of getTerm(), getTermByToken(), __contains__(), iteration and
+   register(), and those that missed, and keeps a histogram of how long they
+   took.  The statistics are returned by snapshot() and written to the log by
+   log_statistics(), which the directive also arranges to happen at exit.
+
+   Rather than test whether it is enabled on every call, instrumentation
+   changes the class of each cluster to a subclass whose methods are
+   instrumented, and back again when disabled.  An uninstrumented cluster
+   thus pays nothing at all for it.  The views of a cluster filtered for
+   each context are instrumented along with it, and counted as the cluster.
+
+   The counts are not locked, so that under heavy contention from many
+   threads a few may be lost.
+"""
+import atexit
+from bisect import bisect_left
+from timeit import default_timer as clock
+
+from zope.component import getUtilitiesFor
+
+from .interfaces import IClusterOfSelectors
+from .zcml_directives import ClusterOfSelectors, FREEZE_ORDER
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+# The upper bounds, in microseconds, of the buckets of the latency histograms.
+# A last bucket holds whatever took longer.
+
+LATENCY_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000)
+
+_statistics_by_cluster = {} # ClusterStatistics by clustername, kept across reloads
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_statistics_by_cluster.clear)
+
+
+class ClusterStatistics(object):
+    """The calls made of one cluster, the misses among them and their latencies.
+    """
+
+    def __init__(self, clustername):
+        self.clustername = clustername
+        self.calls = {}
+        self.misses = {}
+        self.latencies = {} # a list of counts per bucket, by name of call
+
+    def record(self, name, seconds):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            histogram = self.latencies[name] = [0] * (len(LATENCY_BOUNDS) + 1)
+        histogram[bisect_left(LATENCY_BOUNDS, seconds * 1e6)] += 1
+
+    def miss(self, name):
+        self.misses[name] = self.misses.get(name, 0) + 1
+
+    def snapshot(self):
+        """Return a copy of the statistics, as plain dictionaries.
+
+           The histograms are lists of (upper bound in microseconds, count),
+           the last bound being None.
+        """
+
+        bounds = LATENCY_BOUNDS + (None,)
+        return {
+            'calls': dict(self.calls),
+            'misses': dict(self.misses),
+            'latencies': dict((name, list(zip(bounds, histogram)))
+                              for name, histogram in self.latencies.items()),
+            }
+
+
+def statistics_for(clustername):
+    statistics = _statistics_by_cluster.get(clustername)
+    if statistics is None:
+        statistics = _statistics_by_cluster.setdefault(
+            clustername, ClusterStatistics(clustername))
+    return statistics
+
+
+def _timed(name, method):
+    """Return a method that records each call of another, and any LookupError.
+    """
+
+    def instrumented(self, *args, **kw):
+        started = clock()
+        try:
+            return method(self, *args, **kw)
+        except LookupError:
+            self._statistics.miss(name)
+            raise
+        finally:
+            self._statistics.record(name, clock() - started)
+
+    instrumented.__name__ = method.__name__
+    instrumented.__doc__ = method.__doc__
+    return instrumented
+
+
+_instrumented_classes = {}
+
+
+def instrumented_class(cls):
+    """Return the subclass of a class of cluster with its methods instrumented.
+    """
+
+    instrumented = _instrumented_classes.get(cls)
+    if instrumented is not None:
+        return instrumented
+
+    def __init__(self, clustername):
+        cls.__init__(self, clustername) # such as a reloaded cluster
+        self._statistics = statistics_for(clustername)
+
+    def __contains__(self, value):
+        started = clock()
+        found = cls.__contains__(self, value)
+        if not found:
+            self._statistics.miss('__contains__')
+        self._statistics.record('__contains__', clock() - started)
+        return found
+
+    def __iter__(self): # timed until exhausted or abandoned
+        started = clock()
+        try:
+            for term in cls.__iter__(self):
+                yield term
+        finally:
+            self._statistics.record('__iter__', clock() - started)
+
+    def register(self, value, label=None):
+        started = clock()
+        try:
+            cls.extend(self, [(value, label)])
+        finally:
+            self._statistics.record('register', clock() - started)
+
+    def _filteredView(self, version, allowed):
+        view = cls._filteredView(self, version, allowed)
+        instrument(view) # counted under the clustername of the view, as this cluster
+        return view
+
+    instrumented = type(cls.__name__, (cls,), {
+        '__module__': cls.__module__,
+        '__init__': __init__,
+        '__contains__': __contains__,
+        '__iter__': __iter__,
+        'register': register,
+        '_filteredView': _filteredView,
+        'extend': _timed('extend', cls.extend),
+        'getTerm': _timed('getTerm', cls.getTerm),
+        'getTermByToken': _timed('getTermByToken', cls.getTermByToken),
+        '_uninstrumented': cls,
+        })
+    return _instrumented_classes.setdefault(cls, instrumented)
+
+
+def instrument(cluster):
+    if '_uninstrumented' not in type(cluster).__dict__:
+        cluster._statistics = statistics_for(cluster.clustername)
+        cluster.__class__ = instrumented_class(type(cluster))
+
+
+def uninstrument(cluster):
+    uninstrumented = type(cluster).__dict__.get('_uninstrumented')
+    if uninstrumented is not None:
+        cluster.__class__ = uninstrumented
+
+
+def _clusters():
+    """Generate every cluster in the registry, and the filtered views of it made so far.
+    """
+    for clustername, cluster in getUtilitiesFor(IClusterOfSelectors):
+        if isinstance(cluster, ClusterOfSelectors): # not directory listings
+            yield cluster
+            views = cluster._version.derived.get('filtered')
+            if views is not None:
+                for view in views.values():
+                    yield view
+
+
+def enable_instrumentation():
+    """Instrument every cluster in the registry.
+    """
+    for cluster in _clusters():
+        instrument(cluster)
+
+
+def disable_instrumentation():
+    """Remove the instrumentation from every cluster, keeping its statistics.
+    """
+    for cluster in _clusters():
+        uninstrument(cluster)
+
+
+def snapshot():
+    """Return the statistics of every cluster ever instrumented, by clustername.
+    """
+    return dict((clustername, statistics.snapshot())
+                for clustername, statistics in list(_statistics_by_cluster.items()))
+
+
+def log_statistics():
+    """Write the statistics of every instrumented cluster to the log.
+    """
+
+    for clustername, statistics in sorted(snapshot().items()):
+        for name, calls in sorted(statistics['calls'].items()):
+            histogram = ', '.join(
+                '%s%s:%d' % ('<=' if bound is not None else '>',
+                             bound if bound is not None else LATENCY_BOUNDS[-1],
+                             count)
+                for bound, count in statistics['latencies'][name] if count)
+            log.info("Cluster %r %s: %d calls, %d misses, latencies (us) %s"
+                     % (clustername, name, calls, statistics['misses'].get(name, 0),
+                        histogram))
+
+
+def selectorinstrumentation_SimpleDirectiveHandler(_context, dump=True):
+    """Handler of a simple ZCML directive enabling the instrumentation of clusters.
+    """
+
+    def deferred__enable_instrumentation(dump):
+        """The actual handling that is performed at the -END- of configuration.
+
+           Instrument the clusters once they are all complete and frozen.
+        """
+
+        enable_instrumentation()
+        if dump:
+            atexit.register(log_statistics)
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorinstrumentation',),  # must be unique!
+        callable=deferred__enable_instrumentation,
+        args=(dump,),
+        order=FREEZE_ORDER + 2, # after any clusters are moved into shared memory
+        )
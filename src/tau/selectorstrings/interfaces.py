@@ -15,7 +15,25 @@
 """
 
 from zope.interface import Interface
-from zope.schema import TextLine
+from zope.schema import Text, TextLine, Choice, Int, Float
+from zope.configuration.fields import Path, Bool, GlobalInterface, MessageID, Tokens
+
+
+class Label(MessageID):
+    """A label, which is an i18n message id if the ZCML file names an i18n_domain.
+
+       Without a domain the label is plain text, as it always was, rather
+       than a message id of the 'untranslated' domain with a warning.
+    """
+
+    def fromUnicode(self, value):
+        if getattr(self.context, 'i18n_domain', None):
+            return MessageID.fromUnicode(self, value)
+        return Text.fromUnicode(self, value)
+
+    def constraint(self, value):
+        return '\n' not in value and '\r' not in value # as for a TextLine
+
 
 class ISelectorStringDirective(Interface):
     """Schema for a simple, single ZCML directive for declaring a vocabulary of strings.
@@ -38,9 +56,10 @@ class ISelectorStringDirective(Interface):
         required=False,
         )
 
-    label = TextLine(
+    label = Label(
         title=u"Label",
-        description=u"An optional label to display to the user making the choice.",
+        description=u"An optional label to display to the user making the choice, "
+                    u"translated in the i18n_domain of the ZCML file if it has one.",
         required=False,
         )
 
@@ -50,6 +69,19 @@ class ISelectorStringDirective(Interface):
         required=True,
         )
 
+    permission = TextLine(
+        title=u"Permission",
+        description=u"The id of a permission a context must grant to be offered "
+                    u"this string, which otherwise is offered in every context.",
+        required=False,
+        )
+
+    interface = GlobalInterface(
+        title=u"Interface",
+        description=u"An interface a context must provide to be offered this string.",
+        required=False,
+        )
+
 
 class ISelectorClusterDirective(Interface):
     """Schema for a complex, nested ZCML directive for declaring a vocabulary of strings.
@@ -81,6 +113,46 @@ class ISelectorClusterDirective(Interface):
         required=True,
         )
 
+    storage = Choice(
+        title=u"Storage",
+        description=u"How the cluster stores its strings; 'terms' (the default) "
+                    u"or 'compact', which uses far less memory for large clusters.",
+        values=(u'terms', u'compact'),
+        required=False,
+        )
+
+    tokens = Choice(
+        title=u"Tokens",
+        description=u"How the tokens of the strings, used within the HTML, are made; "
+                    u"'value' (the default) uses the value itself, 'digest' a short "
+                    u"digest of it and 'sequential' the position of the string.",
+        values=(u'value', u'digest', u'sequential'),
+        required=False,
+        )
+
+    order = Choice(
+        title=u"Order",
+        description=u"The order in which the strings are listed; 'registration' "
+                    u"(the default), 'label' or 'value'.",
+        values=(u'registration', u'label', u'value'),
+        required=False,
+        )
+
+    collation = TextLine(
+        title=u"Collation",
+        description=u"The locale, such as 'de_DE', by whose rules labels or "
+                    u"values are ordered, rather than by code point.",
+        required=False,
+        )
+
+    mutable = Bool(
+        title=u"Mutable",
+        description=u"Whether strings may still be registered with the cluster "
+                    u"at runtime, once configuration is complete.",
+        required=False,
+        default=False,
+        )
+
 
 class ISelectorStringSubdirective(Interface):
     """Schema for the ZCML directives nested inside the top-level cluster directive.
@@ -106,9 +178,10 @@ class ISelectorStringSubdirective(Interface):
          </selectorcluster>
     """
 
-    label = TextLine(
+    label = Label(
         title=u"Label",
-        description=u"An optional label to display to the user making the choice.",
+        description=u"An optional label to display to the user making the choice, "
+                    u"translated in the i18n_domain of the ZCML file if it has one.",
         required=False,
         )
 
@@ -118,6 +191,366 @@ class ISelectorStringSubdirective(Interface):
         required=True,
         )
 
+    permission = TextLine(
+        title=u"Permission",
+        description=u"The id of a permission a context must grant to be offered "
+                    u"this string, which otherwise is offered in every context.",
+        required=False,
+        )
+
+    interface = GlobalInterface(
+        title=u"Interface",
+        description=u"An interface a context must provide to be offered this string.",
+        required=False,
+        )
+
+
+class ISelectorFileDirective(Interface):
+    """Schema for a simple ZCML directive that loads a cluster from a data file.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.  The rows within the
+       data file itself are *not* validated against a schema, which is what
+       makes this directive cheap for clusters of many thousands of strings.
+
+       Example of the directive:
+
+         <selectorfile
+             cluster="sitedocs"
+             file="sitedocs.csv"
+             />
+
+       A CSV file holds one selectorstring per row, with the value in the
+       first column and an optional label in the second.  A JSON-lines file
+       holds one object per line, such as {"value": "/alpha/", "label": "Alpha"},
+       and a JSON file an array of such objects.
+    """
+
+    cluster = TextLine(
+        title=u"Cluster",
+        description=u"The name of the cluster into which to load the labels/values.",
+        required=True,
+        )
+
+    file = Path(
+        title=u"File",
+        description=u"The data file, relative to the package containing the ZCML.",
+        required=True,
+        )
+
+    format = Choice(
+        title=u"Format",
+        description=u"The format of the data file, 'csv', 'jsonl' or 'json'.  If omitted "
+                    u"it is guessed from the extension of the filename.",
+        values=(u'csv', u'jsonl', u'json'),
+        required=False,
+        )
+
+    storage = Choice(
+        title=u"Storage",
+        description=u"How the cluster stores its strings; 'terms' (the default) "
+                    u"or 'compact', which uses far less memory for large clusters.",
+        values=(u'terms', u'compact'),
+        required=False,
+        )
+
+    tokens = Choice(
+        title=u"Tokens",
+        description=u"How the tokens of the strings, used within the HTML, are made; "
+                    u"'value' (the default) uses the value itself and 'digest' a short "
+                    u"digest of it.  Sequential tokens would change as the file does.",
+        values=(u'value', u'digest'),
+        required=False,
+        )
+
+    order = Choice(
+        title=u"Order",
+        description=u"The order in which the strings are listed; 'registration' "
+                    u"(the default), 'label' or 'value'.",
+        values=(u'registration', u'label', u'value'),
+        required=False,
+        )
+
+    collation = TextLine(
+        title=u"Collation",
+        description=u"The locale, such as 'de_DE', by whose rules labels or "
+                    u"values are ordered, rather than by code point.",
+        required=False,
+        )
+
+
+class ISelectorFilesDirective(Interface):
+    """Schema for a simple ZCML directive that loads a cluster from many data files.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.
+
+       Example of the directive:
+
+         <selectorfiles
+             cluster="sitedocs"
+             files="teams/*.csv shared.jsonl"
+             />
+
+       The files are read concurrently and merged in the order given, those
+       matching a glob pattern in the order of their names.
+    """
+
+    cluster = TextLine(
+        title=u"Cluster",
+        description=u"The name of the cluster into which to load the labels/values.",
+        required=True,
+        )
+
+    files = Tokens(
+        title=u"Files",
+        description=u"The data files, or glob patterns matching them, relative to "
+                    u"the package containing the ZCML.",
+        value_type=Path(),
+        required=True,
+        )
+
+    format = Choice(
+        title=u"Format",
+        description=u"The format of every data file, 'csv', 'jsonl' or 'json'.  If omitted "
+                    u"it is guessed from the extension of each filename.",
+        values=(u'csv', u'jsonl', u'json'),
+        required=False,
+        )
+
+    storage = Choice(
+        title=u"Storage",
+        description=u"How the cluster stores its strings; 'terms' (the default) "
+                    u"or 'compact', which uses far less memory for large clusters.",
+        values=(u'terms', u'compact'),
+        required=False,
+        )
+
+    tokens = Choice(
+        title=u"Tokens",
+        description=u"How the tokens of the strings, used within the HTML, are made; "
+                    u"'value' (the default) uses the value itself and 'digest' a short "
+                    u"digest of it.  Sequential tokens would change as the file does.",
+        values=(u'value', u'digest'),
+        required=False,
+        )
+
+    order = Choice(
+        title=u"Order",
+        description=u"The order in which the strings are listed; 'registration' "
+                    u"(the default), 'label' or 'value'.",
+        values=(u'registration', u'label', u'value'),
+        required=False,
+        )
+
+    collation = TextLine(
+        title=u"Collation",
+        description=u"The locale, such as 'de_DE', by whose rules labels or "
+                    u"values are ordered, rather than by code point.",
+        required=False,
+        )
+
+    workers = Int(
+        title=u"Workers",
+        description=u"The number of data files read at once.",
+        required=False,
+        default=8,
+        min=1,
+        )
+
+    processes = Bool(
+        title=u"Processes",
+        description=u"Whether the data files are read by a pool of processes, for "
+                    u"files costly to parse, rather than of threads.",
+        required=False,
+        default=False,
+        )
+
+
+class ISelectorDirectoryDirective(Interface):
+    """Schema for a simple ZCML directive declaring a cluster of subdirectories.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.
+
+       Example of the directive:
+
+         <selectordirectory
+             cluster="sitedocs"
+             directory="/usr/share/sitedocs"
+             pattern="team-*"
+             ttl="60"
+             />
+    """
+
+    cluster = TextLine(
+        title=u"Cluster",
+        description=u"The name of the cluster of subdirectories.",
+        required=True,
+        )
+
+    directory = Path(
+        title=u"Directory",
+        description=u"The directory whose subdirectories are the values of the cluster.",
+        required=True,
+        )
+
+    pattern = TextLine(
+        title=u"Pattern",
+        description=u"An optional glob pattern the names of the subdirectories must match.",
+        required=False,
+        default=u"*",
+        )
+
+    ttl = Int(
+        title=u"Time To Live",
+        description=u"The seconds for which a listing of the directory is "
+                    u"used before checking whether it has changed.",
+        required=False,
+        default=60,
+        min=0,
+        )
+
+
+class ISelectorCacheDirective(Interface):
+    """Schema for a simple ZCML directive enabling the on-disk cache of clusters.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.  The directive must come
+       before any of the other selector directives.
+
+       Example of the directive:
+
+         <selectorcache
+             file="/var/zope/instance/var/selectorstrings.cache"
+             />
+    """
+
+    file = Path(
+        title=u"File",
+        description=u"The cache file, normally under the var directory of the instance.",
+        required=True,
+        )
+
+
+class ISelectorSharedMemoryDirective(Interface):
+    """Schema for a simple ZCML directive sharing the clusters between processes.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.
+
+       Example of the directive:
+
+         <selectorsharedmemory
+             file="/var/zope/instance/var/selectorstrings.map"
+             />
+    """
+
+    file = Path(
+        title=u"File",
+        description=u"The file to be memory-mapped, shared by all the processes of a host.",
+        required=True,
+        )
+
+
+class ISelectorReloadDirective(Interface):
+    """Schema for a simple ZCML directive starting the reloading of changed clusters.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.
+
+       Example of the directive:
+
+         <selectorreload
+             interval="30"
+             />
+    """
+
+    interval = Int(
+        title=u"Interval",
+        description=u"The seconds between checks of the data files for changes.",
+        required=False,
+        default=30,
+        min=1,
+        )
+
+
+class ISelectorInstrumentationDirective(Interface):
+    """Schema for a simple ZCML directive enabling the instrumentation of clusters.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.
+
+       Example of the directive:
+
+         <selectorinstrumentation
+             dump="true"
+             />
+    """
+
+    dump = Bool(
+        title=u"Dump",
+        description=u"Whether to write the statistics of the clusters to the log at exit.",
+        required=False,
+        default=True,
+        )
+
+
+class ISelectorValidationDirective(Interface):
+    """Schema for a simple ZCML directive validating the paths held by clusters.
+
+       This schema determines the XML attributes accepted by the ZCML
+       directive and how they are parsed/validated.
+
+       Example of the directive:
+
+         <selectorvalidation
+             clusters="sitevids sitedocs"
+             invalid="flag"
+             />
+    """
+
+    clusters = Tokens(
+        title=u"Clusters",
+        description=u"The names of the clusters whose values are paths to validate.",
+        value_type=TextLine(),
+        required=True,
+        )
+
+    kind = Choice(
+        title=u"Kind",
+        description=u"Whether every path must be a 'directory' or a 'file', rather "
+                    u"than either.  A path ending in a slash must be a directory.",
+        values=(u'directory', u'file'),
+        required=False,
+        )
+
+    invalid = Choice(
+        title=u"Invalid",
+        description=u"Whether to only 'log' the invalid paths, or also to 'flag' them "
+                    u"in their clusters or to 'drop' them from their clusters.",
+        values=(u'log', u'flag', u'drop'),
+        required=False,
+        default=u'log',
+        )
+
+    threads = Int(
+        title=u"Threads",
+        description=u"The number of paths checked at once.",
+        required=False,
+        default=32,
+        min=1,
+        )
+
+    timeout = Float(
+        title=u"Timeout",
+        description=u"The seconds after which any path not yet checked is reported "
+                    u"as timed out.",
+        required=False,
+        default=10.0,
+        min=0.0,
+        )
+
 
 class IClusterOfSelectors(Interface):
     """An empty interface for tracking registered clusters in the registry.
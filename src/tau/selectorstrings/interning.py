@@ -0,0 +1,112 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A pool of the strings and terms of every cluster, so each is held only once.
+
+   The same paths and labels often appear in many clusters, yet each string
+   parsed from ZCML or read from a data file is a separate object, as is the
+   term made of it.  While configuration is in progress, every value, token
+   and title registered with any cluster is looked up in this pool and the
+   first such string seen used in its place, as is the first term of the
+   same value, token and title made for the same class of cluster.
+
+   The pool is emptied at the end of configuration, so that it does not go on
+   holding the strings of clusters that are later reloaded or discarded, but
+   the count of the objects and bytes it saved is kept, and logged.
+"""
+import sys
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+text_type = type(u'')
+
+
+class InternPool(object):
+    """The canonical strings and terms, by value, while the pool is active.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.saved_objects = 0
+        self.saved_bytes = 0
+        self._strings = {} # the canonical strings of each exact type, by value
+        self._terms = {}   # the shared terms, by class and identities of strings
+
+    def open(self):
+        self.active = True
+
+    def close(self):
+        """Stop interning, forget everything interned and log what was saved.
+        """
+
+        if self.active:
+            self.active = False
+            self._strings.clear()
+            self._terms.clear()
+            log.info("Interning of selectorstrings saved %d objects, of %d bytes"
+                     % (self.saved_objects, self.saved_bytes))
+
+    def intern(self, obj):
+        """Return the canonical string equal to a string, or any other object as is.
+
+           Strings are pooled by their exact type, so that neither byte and
+           text strings, nor a subclass such as an i18n message id and plain
+           text, are ever taken one for the other.
+        """
+
+        kind = type(obj)
+        if kind is not text_type and kind is not bytes:
+            return obj
+        strings = self._strings.get(kind)
+        if strings is None:
+            strings = self._strings[kind] = {}
+        canonical = strings.setdefault(obj, obj)
+        if canonical is not obj:
+            self.saved_objects += 1
+            self.saved_bytes += sys.getsizeof(obj)
+        return canonical
+
+    def _pooled(self, obj):
+        strings = self._strings.get(type(obj))
+        return strings is not None and strings.get(obj) is obj
+
+    def term(self, cls, value, token, title):
+        """Return the term of a class of cluster for interned strings, made only once.
+        """
+
+        if not (self._pooled(value) and self._pooled(token) and self._pooled(title)):
+            return cls.createTerm(value, token, title)
+
+        # While the pool is active its strings live on, so their ids are unique.
+        key = (cls, id(value), id(token), id(title))
+        term = self._terms.get(key)
+        if term is None:
+            term = self._terms[key] = cls.createTerm(value, token, title)
+        else:
+            self.saved_objects += 1
+            self.saved_bytes += sys.getsizeof(term) + sys.getsizeof(term.__dict__)
+        return term
+
+    def statistics(self):
+        return {'saved_objects': self.saved_objects, 'saved_bytes': self.saved_bytes}
+
+
+pool = InternPool()
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(pool.__init__)
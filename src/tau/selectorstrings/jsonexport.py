@@ -0,0 +1,158 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Serving clusters as JSON, for dropdowns built by the browser.
+
+   A ClusterJSONApplication is a plain WSGI application, which may be mounted
+   alongside Zope by whatever composes the WSGI pipeline, for example with
+   Paste's urlmap::
+
+      [composite:main]
+      use = egg:Paste#urlmap
+      / = zope
+      /selectors = selectors
+
+      [app:selectors]
+      paste.app_factory = tau.selectorstrings.jsonexport:app_factory
+
+   A GET of /selectors/sitevids then returns the cluster named 'sitevids' as
+   a JSON list of {"value", "token", "title"} objects, in its declared order.
+   A title that is an i18n message id is given as its untranslated text.
+
+   The JSON, and a gzip compression of it, are built once for each version
+   of a cluster and kept with that version.  Each carries a strong ETag taken
+   from a digest of the JSON, so a client revalidating its copy with
+   If-None-Match is answered by a 304 with no body at all.
+
+   The application is outside Zope, and so knows nothing of the context in
+   which a cluster would be filtered for the permission= or interface= of
+   its selectorstrings.  A cluster having any such restricted strings is
+   therefore refused, with a 403, rather than served whole.
+"""
+import json
+import zlib
+from hashlib import sha1
+
+from zope.component import queryUtility
+
+from .interfaces import IClusterOfSelectors
+from .zcml_directives import label_text
+
+
+def _gzip(data):
+    # A gzip stream with no file name and a zero timestamp, so that the same
+    # JSON always compresses to the same bytes.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def cluster_json(cluster):
+    """Return the (json, gzipped, etag) of a cluster, building them only once per version.
+    """
+
+    version = getattr(cluster, '_version', None) # as has every cluster of ours
+    if version is not None:
+        cached = version.derived.get('json')
+        if cached is not None:
+            return cached
+
+    body = json.dumps([{'value': term.value, 'token': term.token, 'title': label_text(term.title)}
+                       for term in cluster], separators=(',', ':'))
+    if not isinstance(body, bytes):
+        body = body.encode('ascii')
+    exported = (body, _gzip(body), sha1(body).hexdigest())
+
+    if version is not None:
+        version.derived['json'] = exported
+    return exported
+
+
+def is_restricted(cluster):
+    """Return whether any selectorstring of a cluster is restricted to some contexts.
+    """
+    version = getattr(cluster, '_version', None)
+    return bool(getattr(version, 'predicates', None))
+
+
+def _accepts_gzip(environ):
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip() not in ('gzip', 'x-gzip', '*'):
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        return quality > 0
+    return False
+
+
+class ClusterJSONApplication(object):
+    """A WSGI application serving a cluster, named by the path or fixed, as JSON.
+    """
+
+    def __init__(self, clustername=None):
+        self.clustername = clustername
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'),
+                                                      ('Content-Length', '0')])
+            return []
+
+        clustername = self.clustername or environ.get('PATH_INFO', '').strip('/')
+        cluster = queryUtility(IClusterOfSelectors, name=clustername) if clustername else None
+        if cluster is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain'),
+                                             ('Content-Length', '0')])
+            return []
+        if is_restricted(cluster):
+            start_response('403 Forbidden', [('Content-Type', 'text/plain'),
+                                             ('Content-Length', '0')])
+            return []
+
+        body, gzipped, digest = cluster_json(cluster)
+        headers = [('Content-Type', 'application/json'),
+                   ('Cache-Control', 'no-cache'), # but revalidate by ETag
+                   ('Vary', 'Accept-Encoding')]
+        if _accepts_gzip(environ):
+            body = gzipped
+            etag = '"%s-gzip"' % digest # each encoding has its own strong ETag
+            headers.append(('Content-Encoding', 'gzip'))
+        else:
+            etag = '"%s"' % digest
+        headers.append(('ETag', etag))
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            if etag in tags or '*' in tags:
+                start_response('304 Not Modified', headers)
+                return []
+
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        if method == 'HEAD':
+            return []
+        return [body]
+
+
+def app_factory(global_config, clustername=None, **local_config):
+    """A PasteDeploy factory of the application.
+    """
+    return ClusterJSONApplication(clustername)
@@ -0,0 +1,584 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Clusters shared, through a memory-mapped file, by all the workers of a host.
+
+   Every Zope worker process resolves the very same clusters and holds its
+   own copy of them as Python objects.  Given the directive::
+
+      <selectorsharedmemory file="/var/zope/instance/var/selectorstrings.map" />
+
+   the resolved clusters are instead written, at the end of configuration,
+   to a file in a compact read-only binary format, and each worker replaces
+   them with clusters that read from a memory mapping of that file.  Since
+   the operating system keeps but one copy of the pages of a mapped file,
+   the strings are held only once per host however many workers there are.
+
+   The first worker to start writes the file, and the others, finding it
+   already holds exactly their clusters, merely map it.  Only frozen clusters
+   of text values and labels are shared; mutable ones, directory listings and
+   those of other values are left as they are.  Shared clusters are not
+   reloaded when their data files change.
+
+   Finding that the file holds their clusters, however, means that each
+   worker has first built them.  So where a <selectorcache> is also given,
+   and every cluster could be shared, the file is marked with the digest of
+   the fingerprint of the sources of the cache.  A worker starting with the
+   same fingerprint then maps the file before any cluster is built, and the
+   building actions do nothing, just as when the clusters are loaded from
+   the cache.
+
+   The file starts with a header and a directory of the clusters within it,
+   and the settings, such as the order, of each as JSON.
+   Each cluster then has a section holding, for its values, tokens and
+   titles, a table of the (offset, length) of each within a blob of UTF-8
+   text, and for its values and tokens an open-addressed hash table of the
+   positions of the strings, keyed by CRC-32, so that a lookup reads only a
+   few words of the mapping and compares one string.  Should any title be an
+   i18n message id, the section also holds such tables of the domain and
+   default of every title, which are then read as message ids.
+"""
+import json
+import marshal
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from hashlib import sha1
+
+from zope.component import getUtilitiesFor, provideUtility
+from zope.i18nmessageid import Message
+from zope.schema.interfaces import IVocabularyFactory
+
+from .interfaces import IClusterOfSelectors
+from .vocabulary import ClusterVocabularyFactory, provide_cluster
+from .zcml_directives import ClusterOfSelectors, CompactClusterOfSelectors
+from .zcml_directives import CLUSTER_STORAGES, FREEZE_ORDER
+from .zcml_directives import configuration_machine, record_sources
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+MAGIC = b'TAUSEL03'
+HEADER = struct.Struct('<8s20sI20s') # magic, SHA-1 of sources and body, clusters, sources
+ENTRY = struct.Struct('<IIIII')      # name offset and length, section, settings offset and length
+SECTION = struct.Struct('<III')    # strings, size of hash tables, flags
+WORD = struct.Struct('<I')
+
+TOKENS_ARE_TEXT = 1    # a flag of a section, otherwise tokens are byte strings
+TITLES_ARE_MESSAGES = 2 # a flag of a section holding the domains and defaults of titles
+
+NONE_LENGTH = 0xffffffff # the length of a string that is None, such as a default
+
+NO_SOURCES = b'\0' * 20 # the sources of a file whose clusters were not all cached
+
+text_type = type(u'')
+
+
+def _words(values):
+    words = array('I', values)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tostring() if hasattr(words, 'tostring') else words.tobytes()
+
+
+def _hash(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _is_message(title):
+    return (type(title) is Message and title.mapping is None
+            and type(title.default) in (text_type, type(None)))
+
+
+def sources_digest(cache):
+    """Return the digest of the fingerprint of the sources of a startup cache, or None.
+    """
+
+    fingerprint = cache.fingerprint() if cache is not None else None
+    if fingerprint is None:
+        return None
+    return sha1(marshal.dumps(fingerprint)).digest()
+
+
+def unshareable_reason(cluster):
+    """Return why a cluster cannot be moved into shared memory, or None if it can.
+    """
+
+    if isinstance(cluster, MappedClusterOfSelectors):
+        return 'it is already shared'
+    if not isinstance(cluster, ClusterOfSelectors) or cluster.storage not in CLUSTER_STORAGES:
+        return 'it is not a cluster of selectorstrings'
+    if not cluster.frozen or cluster.mutable:
+        return 'it is mutable'
+    token_type = None
+    for term in cluster.ordered('registration'):
+        if type(term.value) is not text_type:
+            return 'the value %r is not text' % (term.value,)
+        if type(term.title) is not text_type and not _is_message(term.title):
+            return 'the label %r is neither text nor a plain message id' % (term.title,)
+        if token_type is None:
+            token_type = type(term.token)
+        if type(term.token) is not token_type or token_type not in (bytes, text_type):
+            return 'the token %r is of another type than the others' % (term.token,)
+    return None
+
+
+def is_shareable(cluster):
+    """Return whether a cluster can be moved into shared memory.
+    """
+    return unshareable_reason(cluster) is None
+
+
+def pack_section(cluster):
+    """Return the bytes of the section of one cluster.
+    """
+
+    terms = cluster.ordered('registration')
+    count = len(terms)
+    size = 1
+    while size < 2 * count:
+        size *= 2
+
+    flags = TOKENS_ARE_TEXT if terms and type(terms[0].token) is text_type else 0
+    if any(type(term.title) is Message for term in terms):
+        flags |= TITLES_ARE_MESSAGES
+    blob = []
+    length = 0
+    pairs = {'value': [], 'token': [], 'title': [], 'domain': [], 'default': []}
+    domains = {} # the pair of each domain, stored only once
+    tables = {'value': [0] * size, 'token': [0] * size}
+
+    for position, term in enumerate(terms):
+        value = term.value.encode('utf-8')
+        token = term.token.encode('utf-8') if flags & TOKENS_ARE_TEXT else term.token
+        title = term.title.encode('utf-8')
+
+        value_pair = (length, len(value))
+        blob.append(value)
+        length += len(value)
+        pairs['value'].extend(value_pair)
+        for name, data in (('token', token), ('title', title)):
+            if data == value: # shares the bytes of the value
+                pairs[name].extend(value_pair)
+            else:
+                pairs[name].extend((length, len(data)))
+                blob.append(data)
+                length += len(data)
+
+        if flags & TITLES_ARE_MESSAGES:
+            domain = getattr(term.title, 'domain', None)
+            default = getattr(term.title, 'default', None)
+            if domain is None:
+                pairs['domain'].extend((0, NONE_LENGTH))
+            else:
+                data = domain if isinstance(domain, bytes) else domain.encode('utf-8')
+                if data not in domains:
+                    domains[data] = (length, len(data))
+                    blob.append(data)
+                    length += len(data)
+                pairs['domain'].extend(domains[data])
+            if default is None:
+                pairs['default'].extend((0, NONE_LENGTH))
+            else:
+                data = default.encode('utf-8')
+                pairs['default'].extend((length, len(data)))
+                blob.append(data)
+                length += len(data)
+
+        for name, data in (('value', value), ('token', token)):
+            table = tables[name]
+            slot = _hash(data) & (size - 1)
+            while table[slot]:
+                slot = (slot + 1) & (size - 1)
+            table[slot] = position + 1
+
+    return b''.join([SECTION.pack(count, size, flags),
+                     _words(pairs['value']), _words(pairs['token']), _words(pairs['title']),
+                     _words(pairs['domain']), _words(pairs['default']),
+                     _words(tables['value']), _words(tables['token'])] + blob)
+
+
+def pack_clusters(clusters, sources=NO_SOURCES):
+    """Return the bytes of a file holding some (clustername, cluster) pairs.
+
+       The sources are the digest of the sources from which the clusters were
+       built, should the file hold every cluster of a startup cache.
+    """
+
+    names = [clustername.encode('utf-8') for clustername, cluster in clusters]
+    settings = [json.dumps(dict((name, getattr(cluster, name)) for name in cluster.settings),
+                           sort_keys=True).encode('ascii')
+                for clustername, cluster in clusters]
+    sections = [pack_section(cluster) for clustername, cluster in clusters]
+
+    offset = HEADER.size + ENTRY.size * len(clusters)
+    entries = []
+    for name, setting in zip(names, settings):
+        entries.append([offset, len(name), 0, offset + len(name), len(setting)])
+        offset += len(name) + len(setting)
+    for entry, section in zip(entries, sections):
+        offset += -offset % 4 # sections are aligned on words
+        entry[2] = offset
+        offset += len(section)
+
+    body = [ENTRY.pack(*entry) for entry in entries]
+    for name, setting in zip(names, settings):
+        body.extend((name, setting))
+    end = HEADER.size + sum(len(piece) for piece in body)
+    for entry, section in zip(entries, sections):
+        body.append(b'\0' * (entry[2] - end))
+        body.append(section)
+        end = entry[2] + len(section)
+
+    body = b''.join(body)
+    return HEADER.pack(MAGIC, sha1(sources + body).digest(), len(clusters), sources) + body
+
+
+class MappedStrings(object):
+    """The values, tokens or titles of a section, as a read-only sequence.
+    """
+
+    def __init__(self, mapping, pairs, count, blob, text=True):
+        self.mapping = mapping
+        self.pairs = pairs
+        self.count = count
+        self.blob = blob
+        self.text = text
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        offset, length = struct.unpack_from('<II', self.mapping, self.pairs + 8 * position)
+        if length == NONE_LENGTH:
+            return None
+        data = self.mapping[self.blob + offset:self.blob + offset + length]
+        return data.decode('utf-8') if self.text else data
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self[position]
+
+
+class MappedMessages(object):
+    """The titles of a section that are i18n message ids, as a read-only sequence.
+    """
+
+    def __init__(self, titles, domains, defaults):
+        self.titles = titles
+        self.domains = domains
+        self.defaults = defaults
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, position):
+        title = self.titles[position]
+        domain = self.domains[position]
+        if domain is None:
+            return title
+        return Message(title, domain, self.defaults[position])
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+
+class MappedIndex(object):
+    """The positions of the values or tokens of a section, by value or token.
+    """
+
+    def __init__(self, mapping, strings, table, size):
+        self.mapping = mapping
+        self.strings = strings
+        self.table = table
+        self.size = size
+
+    def __getitem__(self, key):
+        if isinstance(key, text_type):
+            data = key.encode('utf-8')
+        elif isinstance(key, bytes):
+            data = key # equal to, and so found as, the same text if ASCII
+        else:
+            raise KeyError(key)
+
+        mapping = self.mapping
+        strings = self.strings
+        slot = _hash(data) & (self.size - 1)
+        while True:
+            entry = WORD.unpack_from(mapping, self.table + 4 * slot)[0]
+            if not entry:
+                raise KeyError(key)
+            offset, length = struct.unpack_from('<II', mapping, strings.pairs + 8 * (entry - 1))
+            if length == len(data) and mapping[strings.blob + offset:
+                                               strings.blob + offset + length] == data:
+                return entry - 1
+            slot = (slot + 1) & (self.size - 1)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class MappedVersion(object):
+    """The one and only version of a cluster in shared memory.
+
+       It has the sequences and indexes of the compact layout, read from the
+       mapping, and like any other version a cache of whatever is derived
+       from its strings, which however is private to each process.
+    """
+
+    def __init__(self, mapping, offset):
+        count, size, flags = SECTION.unpack_from(mapping, offset)
+        pairs = offset + SECTION.size
+        tables = 5 if flags & TITLES_ARE_MESSAGES else 3
+        values, tokens, titles, domains, defaults = [pairs + 8 * count * i for i in range(5)]
+        value_table = pairs + 8 * count * tables
+        token_table = value_table + 4 * size
+        blob = token_table + 4 * size
+
+        self.values = MappedStrings(mapping, values, count, blob)
+        self.tokens = MappedStrings(mapping, tokens, count, blob, flags & TOKENS_ARE_TEXT)
+        self.titles = MappedStrings(mapping, titles, count, blob)
+        if flags & TITLES_ARE_MESSAGES:
+            self.titles = MappedMessages(self.titles,
+                                         MappedStrings(mapping, domains, count, blob),
+                                         MappedStrings(mapping, defaults, count, blob))
+        self.positions_by_value = MappedIndex(mapping, self.values, value_table, size)
+        self.positions_by_token = MappedIndex(mapping, self.tokens, token_table, size)
+
+        self.predicates = {} # those of the cluster, private to each process
+        self.derived = {}    # such as the search index, built only once searched
+
+    def freeze(self):
+        pass # never anything but frozen
+
+
+class MappedClusterOfSelectors(CompactClusterOfSelectors):
+    """A frozen cluster reading its strings from a section of a shared mapping.
+    """
+
+    storage = 'mapped'
+
+    def __init__(self, clustername, version=None):
+        CompactClusterOfSelectors.__init__(self, clustername)
+        if version is not None:
+            self._version = version
+        self.frozen = True
+        self.sources = ()
+        self.restrictable = False # whether still being configured, having been mapped first
+
+    def restrict(self, value, permission=None, interface=None):
+        """Show the selectorstring of a value only in some contexts.
+
+           The strings are shared but the restrictions are not, so a cluster
+           mapped before being configured, as by a worker starting with the
+           same sources as the one that shared it, may still be restricted
+           until it is frozen, at the end of configuration.
+        """
+
+        if not self.restrictable:
+            return CompactClusterOfSelectors.restrict(self, value, permission, interface)
+        with self._writing:
+            version = self._version
+            if value not in self._valueIndex(version):
+                raise LookupError(value)
+            version.predicates[value] = (permission, interface)
+            version.derived.clear()
+
+    def freeze(self):
+        self.restrictable = False # the strings themselves were ever frozen
+
+
+def open_clusters(path, expected_digest=None):
+    """Map a file of clusters, returning the (clustername, cluster) within it.
+
+       Given the digest of the clusters expected, a ValueError is raised
+       should the file hold any others.
+    """
+
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, digest, count, sources = HEADER.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise ValueError("%r is not a file of clusters" % path)
+    if expected_digest is not None and digest != expected_digest:
+        raise ValueError("%r holds other clusters than expected" % path)
+
+    clusters = []
+    for i in range(count):
+        name_offset, name_length, offset, settings_offset, settings_length = \
+            ENTRY.unpack_from(mapping, HEADER.size + ENTRY.size * i)
+        clustername = mapping[name_offset:name_offset + name_length].decode('utf-8')
+        cluster = MappedClusterOfSelectors(clustername, MappedVersion(mapping, offset))
+        settings = json.loads(
+            mapping[settings_offset:settings_offset + settings_length].decode('ascii'))
+        for name, setting in settings.items():
+            setattr(cluster, str(name), setting)
+        clusters.append((clustername, cluster))
+    return clusters
+
+
+def _current_header(path):
+    """Return the (digest, sources) of a file of clusters, or None.
+    """
+    try:
+        with open(path, 'rb') as f:
+            magic, digest, count, sources = HEADER.unpack(f.read(HEADER.size))
+    except (IOError, struct.error):
+        return None
+    return (digest, sources) if magic == MAGIC else None
+
+
+def _current_digest(path):
+    header = _current_header(path)
+    return header[0] if header is not None else None
+
+
+def map_shared_clusters(path, cache):
+    """Provide the clusters of a file shared from the very same sources, if any.
+
+       Should the file have been written from the sources of the startup
+       cache as they are now, its clusters are provided straight away, and
+       the cache marked as loaded so that nothing else builds them.  Returns
+       the names of the clusters provided, or None if the file is not such.
+    """
+
+    sources = sources_digest(cache)
+    header = _current_header(path)
+    if sources is None or header is None or header[1] != sources:
+        return None
+    try:
+        opened = open_clusters(path, header[0])
+    except (IOError, ValueError):
+        return None # replaced by another worker since
+
+    for clustername, mapped in opened:
+        mapped.restrictable = True
+        provide_cluster(mapped, clustername)
+        provideUtility(ClusterVocabularyFactory(clustername, mapped),
+                       provides=IVocabularyFactory, name=clustername)
+    cache.loaded = True
+    log.info("Mapped %d clusters shared through %r" % (len(opened), path))
+    return [clustername for clustername, mapped in opened]
+
+
+def share_clusters(path, cache=None):
+    """Move every shareable cluster in the registry into a shared mapping of a file.
+
+       The file is written only if it does not already hold exactly these
+       clusters, so that workers with the same configuration map the same file.
+       Whatever another worker, of another configuration, may write to the
+       file meanwhile, the clusters mapped are checked to be exactly these,
+       or else the clusters are left unshared.  Should every cluster be
+       shared, the file is marked with the sources of any startup cache.
+    """
+
+    clusters = []
+    complete = True
+    for clustername, cluster in sorted(getUtilitiesFor(IClusterOfSelectors)):
+        reason = unshareable_reason(cluster)
+        if reason is None:
+            clusters.append((clustername, cluster))
+        elif isinstance(cluster, ClusterOfSelectors):
+            log.info("Not sharing cluster %r, as %s" % (clustername, reason))
+            complete = False
+    sources = sources_digest(cache) if complete else None
+    data = pack_clusters(clusters, sources or NO_SOURCES)
+    digest = HEADER.unpack_from(data, 0)[1]
+
+    opened = None
+    if _current_digest(path) == digest:
+        try:
+            opened = open_clusters(path, digest)
+        except (IOError, ValueError):
+            pass # replaced by another worker since
+    if opened is None:
+        # Map our own file before renaming it into place, so that the mapping
+        # is of it, whatever is renamed over it next.
+        scratch = '%s.%d' % (path, os.getpid())
+        with open(scratch, 'wb') as f:
+            f.write(data)
+        opened = open_clusters(scratch, digest)
+        os.rename(scratch, path) # never seen half-written by another worker
+
+    if [mapped_name for mapped_name, mapped in opened] != [
+            clustername for clustername, cluster in clusters]:
+        log.warning("Not sharing clusters through %r, which holds others" % path)
+        return []
+
+    for (clustername, cluster), (mapped_name, mapped) in zip(clusters, opened):
+        for name in cluster.settings:
+            setattr(mapped, name, getattr(cluster, name))
+        mapped._version.predicates = dict(cluster._version.predicates)
+        mapped.invalid = cluster.invalid
+        provide_cluster(mapped, clustername)
+
+    log.info("Shared %d clusters through %r, of %d bytes"
+             % (len(clusters), path, len(data)))
+    return [clustername for clustername, cluster in clusters]
+
+
+def selectorsharedmemory_SimpleDirectiveHandler(_context, file):
+    """Handler of a simple ZCML directive sharing the clusters between processes.
+    """
+
+    record_sources(_context)
+    cache = configuration_machine(_context).__dict__.get('selectorstrings_cache')
+    mapped = [] # the names of the clusters mapped before any were built
+
+    def deferred__map_clusters(path, cache):
+        """The actual handling that is performed at the -START- of the actions.
+
+           Map the clusters straight away should they have been shared from
+           the very same sources, before the startup cache is even loaded.
+        """
+        mapped.extend(map_shared_clusters(path, cache) or ())
+
+    def deferred__share_clusters(path, cache):
+        """The actual handling that is performed at the -END- of configuration.
+
+           Share the clusters once they are all complete and frozen.
+        """
+        if not mapped:
+            share_clusters(path, cache)
+
+    if cache is not None:
+        _context.action( # register an action to occur at the start of the actions
+            discriminator=('selectorsharedmemory', 'map'),  # must be unique!
+            callable=deferred__map_clusters,
+            args=(file, cache),
+            order=-FREEZE_ORDER - 1,
+            )
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorsharedmemory',),  # must be unique!
+        callable=deferred__share_clusters,
+        args=(file, cache),
+        order=FREEZE_ORDER + 1,
+        )
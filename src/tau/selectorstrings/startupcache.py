@@ -0,0 +1,127 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""An on-disk cache of the fully resolved clusters, across restarts.
+
+   Every restart of Zope re-parses the selector ZCML, and the data files it
+   names, and replays every deferred action to rebuild exactly the same
+   clusters as last time.  When a <selectorcache> directive is given, the
+   resolved clusters are written to a file at the end of configuration along
+   with a fingerprint of every ZCML and data file that contributed to them.
+   On the next start, if none of those files has changed, the clusters are
+   loaded straight from that file instead.
+
+   The file is written using marshal, which is fast but specific to a version
+   of Python, so that version is made part of the fingerprint too.  Marshal
+   knows nothing of i18n message ids, so a label that is one is written as a
+   (msgid, domain, default) tuple instead.
+"""
+import marshal
+import os
+import sys
+
+from zope.i18nmessageid import Message
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+CACHE_FORMAT = 5
+
+
+def _pack_selectors(selectors):
+    return tuple((value, (u'%s' % label, label.domain, label.default)
+                          if isinstance(label, Message) else label)
+                 for value, label in selectors)
+
+
+def _unpack_selectors(selectors):
+    return tuple((value, Message(label[0], label[1], label[2])
+                          if isinstance(label, tuple) else label)
+                 for value, label in selectors)
+
+
+class StartupCache(object):
+    """The cache file for one configuration process, and the files it depends on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = set() # the files contributing to the clusters
+        self.loaded = False  # whether the clusters came from the cache file
+
+    def addSource(self, path):
+        self.sources.add(path)
+
+    def fingerprint(self):
+        """Return the (path, mtime, size) of every source, or None.
+
+           None is returned if any source is not a file on disk, such as ZCML
+           given as a string, since its changes could not be detected.
+        """
+
+        fingerprint = [(CACHE_FORMAT, sys.version)]
+        for path in sorted(self.sources):
+            try:
+                info = os.stat(path)
+            except (OSError, TypeError):
+                return None
+            fingerprint.append((path, info.st_mtime, info.st_size))
+        return tuple(fingerprint)
+
+    def load(self):
+        """Return the clusters cached for the current fingerprint, or None.
+
+           The clusters are a sequence of (clustername, storage, settings,
+           selectors, sources) where the settings are a dictionary of those
+           named by ClusterOfSelectors.settings, the selectors a sequence of
+           (value, label) pairs in the order of registration and the sources
+           are those recorded by the cluster.
+        """
+
+        fingerprint = self.fingerprint()
+        if fingerprint is None:
+            return None
+
+        try:
+            with open(self.path, 'rb') as f:
+                cached_fingerprint, clusters = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None # missing, unreadable or not our format
+
+        if cached_fingerprint != fingerprint:
+            log.info("Selector cache %r is out of date" % self.path)
+            return None
+        return tuple((clustername, storage, settings, _unpack_selectors(selectors), sources)
+                     for clustername, storage, settings, selectors, sources in clusters)
+
+    def save(self, clusters):
+        """Write the clusters, in the form returned by load(), to the cache file.
+        """
+
+        fingerprint = self.fingerprint()
+        if fingerprint is None:
+            log.info("Not writing selector cache %r, as some of its sources "
+                     "are not files" % self.path)
+            return
+
+        # Write to a scratch file and rename it into place, so that a worker
+        # starting concurrently never reads a half-written cache.
+        clusters = tuple((clustername, storage, settings, _pack_selectors(selectors), sources)
+                         for clustername, storage, settings, selectors, sources in clusters)
+        scratch = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(scratch, 'wb') as f:
+                marshal.dump((fingerprint, clusters), f)
+            os.rename(scratch, self.path)
+        except (IOError, OSError) as e:
+            log.warning("Could not write selector cache %r: %s" % (self.path, e))
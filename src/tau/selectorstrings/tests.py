@@ -0,0 +1,1034 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests of the selectorstring directives and clusters.
+
+   Run by the zope.testing test runner of the buildout, as bin/test.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from zope.component import getUtility
+from zope.configuration import xmlconfig
+from zope.testing.cleanup import CleanUp
+
+from .interfaces import IClusterOfSelectors
+from .zcml_directives import CLUSTER_STORAGES
+
+
+ZCML = '''<configure xmlns="http://namespaces.zope.org/zope">
+<include package="tau.selectorstrings" file="meta.zcml" />
+%s
+</configure>'''
+
+
+class SelectorTestCase(CleanUp, unittest.TestCase):
+    """A test with a scratch directory, into which ZCML and data files are written.
+    """
+
+    def setUp(self):
+        CleanUp.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        CleanUp.tearDown(self)
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def configure(self, body):
+        """Execute ZCML from a file, as a file so that it can be fingerprinted.
+
+           The file is given the same time whenever written, so that the
+           startup cache sees it unchanged should the same ZCML be executed.
+        """
+        xmlconfig.file(self.write('configure.zcml', (ZCML % body).encode('utf-8'),
+                                  mtime=1000000000))
+
+    def cluster(self, clustername):
+        return getUtility(IClusterOfSelectors, name=clustername)
+
+    def values(self, cluster):
+        return [term.value for term in cluster]
+
+
+class DataFileTests(SelectorTestCase):
+
+    def test_json(self):
+        from .datafiles import iter_selectors
+        path = self.write('a.json', b'[{"value": "/alpha/", "label": "Alpha"}, {"value": "/beta/"}]')
+        self.assertEqual(list(iter_selectors(path)), [(u'/alpha/', u'Alpha'), (u'/beta/', None)])
+
+    def test_json_in_chunks(self):
+        from .datafiles import iter_json_selectors
+        rows = [(u'/path%d/' % i, u'L\xe4bel %d' % i if i % 3 else None) for i in range(50)]
+        path = self.write('a.json', json.dumps(
+            [dict(value=value, label=label) for value, label in rows], indent=1).encode('utf-8'))
+        for chunk in (1, 7, 100, 65536):
+            self.assertEqual(list(iter_json_selectors(path, chunk)), rows)
+        for data in (b'', b'[', b'[{"value": "/a/"}', b'[{"value": "/a/"},]', b'{}',
+                     b'[{"value": "/a/"}] x'):
+            path = self.write('b.json', data)
+            self.assertRaises(ValueError, list, iter_json_selectors(path, 4))
+        self.assertEqual(list(iter_json_selectors(self.write('c.json', b' [ ] '))), [])
+
+    def test_non_ascii_values(self):
+        path = self.write('a.csv', u'/caf\xe9/,Caf\xe9\n/tea/\n'.encode('utf-8'))
+        for storage in CLUSTER_STORAGES:
+            self.cleanUp()
+            self.configure('<selectorfile cluster="a" file="%s" storage="%s" />'
+                           % (path, storage))
+            cluster = self.cluster('a')
+            self.assertEqual([term.token for term in cluster], ['/caf\\xe9/', '/tea/'])
+            self.assertEqual(cluster.getTermByToken('/caf\\xe9/').value, u'/caf\xe9/')
+
+    def test_not_strings(self):
+        from .datafiles import iter_selectors
+        for name, data in (('a.jsonl', b'{"value": "/alpha/"}\n{"value": 5}\n'),
+                           ('b.jsonl', b'\n{"value": "/x/", "label": ["a"]}\n'),
+                           ('c.json', b'[{"value": "/alpha/"}, {"value": true}]'),
+                           ('d.jsonl', b'["/x/"]\n')):
+            path = self.write(name, data)
+            try:
+                list(iter_selectors(path))
+            except ValueError as e:
+                self.assertTrue(str(e).startswith(path + ', '), str(e))
+            else:
+                self.fail('%s was read' % name)
+
+    def test_sequential_tokens_refused(self):
+        from zope.configuration.exceptions import ConfigurationError
+        path = self.write('a.csv', b'/a/,A\n')
+        self.assertRaises(ConfigurationError, self.configure,
+                          '<selectorfile cluster="a" file="%s" tokens="sequential" />' % path)
+        self.assertRaises(ConfigurationError, self.configure, '''
+            <selectorcluster name="b" tokens="sequential">
+              <selectorstring value="/z/" />
+            </selectorcluster>
+            <selectorfile cluster="b" file="%s" />''' % path)
+
+
+class AccumulationTests(SelectorTestCase):
+
+    def body(self, accumulate):
+        return '''
+            <configure xmlns:meta="http://namespaces.zope.org/meta">
+                %s
+                <selectorstring cluster="a" value="/alpha/" />
+                <selectorfile cluster="a" file="%s" />
+                <selectorcluster name="a">
+                    <selectorstring value="/beta/" />
+                </selectorcluster>
+                <selectorstring cluster="b" value="/one/" />
+                <selectorfiles cluster="a" files="%s" />
+                <selectorstring cluster="a" value="/gamma/" />
+            </configure>
+            ''' % ('<meta:provides feature="selectorstrings-accumulate" />' if accumulate else '',
+                   self.write('a.csv', b'/file/\n'), self.write('b.csv', b'/files/\n'))
+
+    def test_order_kept(self):
+        expected = [u'/alpha/', u'/file/', u'/beta/', u'/files/', u'/gamma/']
+        for accumulate in (False, True):
+            self.cleanUp()
+            self.configure(self.body(accumulate))
+            self.assertEqual(self.values(self.cluster('a')), expected)
+            self.assertEqual(self.values(self.cluster('b')), [u'/one/'])
+
+
+class ProfileTests(SelectorTestCase):
+
+    def test_report(self):
+        import logging
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('tau.selectorstrings')
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            self.configure('''
+                <configure xmlns:meta="http://namespaces.zope.org/meta">
+                    <meta:provides feature="selectorstrings-profile" />
+                    <selectorstring cluster="a" value="/alpha/" />
+                    <selectorstring cluster="a" value="/beta/" />
+                    <selectorcluster name="b">
+                        <selectorstring value="/gamma/" />
+                    </selectorcluster>
+                    <selectorfile cluster="c" file="%s" />
+                </configure>''' % self.write('c.csv', b'/delta/\n'))
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        lines = [record.getMessage() for record in records]
+        report = lines[lines.index("Selector configuration profile, slowest first:") + 1:]
+        zcml = os.path.join(self.directory, 'configure.zcml')
+        self.assertEqual(report[0].split(), [report[0].split()[0], zcml])
+        calls = dict((tuple(line.split()[3:]), int(line.split()[1]))
+                     for line in report[1:] if ' calls ' in line)
+        for phase, count in ((("u'a'", 'selectorstring_SimpleDirectiveHandler'), 2),
+                             (("u'a'", 'deferred__append_selector'), 2),
+                             (("u'b'", 'selectorcluster_ComplexDirectiveHandler.selectorstring'), 1),
+                             (("u'c'", 'deferred__load_selectorfile'), 1)):
+            self.assertEqual(calls[(zcml, 'cluster') + phase], count, phase)
+
+
+class InterningTests(SelectorTestCase):
+
+    def test_shared_between_clusters(self):
+        from .interning import pool
+        self.configure('''
+            <selectorstring cluster="a" value="/docs/" label="Docs" />
+            <selectorstring cluster="b" value="/docs/" label="Docs" />
+            <selectorcluster name="c" storage="compact">
+                <selectorstring value="/docs/" label="Docs" />
+            </selectorcluster>
+            <selectorfile cluster="d" file="%s" />''' % self.write('d.csv', b'/docs/,Docs\n'))
+        a, b, c, d = [self.cluster(name).getTerm(u'/docs/') for name in 'abcd']
+        self.assertTrue(a is b and a is d)
+        self.assertTrue(c.value is a.value and c.title is a.title)
+        self.assertFalse(pool.active)
+        self.assertEqual((pool._strings, pool._terms), ({}, {}))
+        self.assertTrue(pool.saved_objects >= 8)
+
+    def test_types_kept_apart(self):
+        from zope.i18nmessageid import Message
+        from .interning import InternPool
+        pool = InternPool()
+        pool.open()
+        first, second = u''.join([u'do', u'cs']), u''.join([u'do', u'cs'])
+        self.assertTrue(pool.intern(first) is first)
+        self.assertTrue(pool.intern(second) is first)
+        message, data = Message(u'docs', 'tau'), b'docs'
+        self.assertTrue(pool.intern(message) is message)
+        self.assertTrue(pool.intern(data) is data)
+        self.assertEqual(pool.intern(5), 5)
+        pool.close()
+        self.assertFalse(pool.active)
+
+
+class FreezeTests(SelectorTestCase):
+
+    def test_frozen_after_configuration(self):
+        self.configure('''
+            <selectorstring cluster="a" value="/alpha/" />
+            <selectorcluster name="b" storage="compact" mutable="true">
+                <selectorstring value="/beta/" />
+            </selectorcluster>''')
+        a, b = self.cluster('a'), self.cluster('b')
+        self.assertTrue(a.frozen and b.frozen)
+        self.assertTrue(isinstance(a._terms, tuple))
+        self.assertRaises(ValueError, a.register, u'/gamma/')
+        self.assertEqual(self.values(a), [u'/alpha/'])
+
+        b.register(u'/gamma/')
+        self.assertEqual(self.values(b), [u'/beta/', u'/gamma/'])
+        self.assertRaises(ValueError, b.register, u'/gamma/') # a duplicate
+        self.assertEqual(self.values(b), [u'/beta/', u'/gamma/'])
+
+
+class BatchLookupTests(unittest.TestCase):
+
+    def clusters(self):
+        from .sharedmemory import pack_clusters, open_clusters
+        for storage, cls in sorted(CLUSTER_STORAGES.items()):
+            cluster = cls('a')
+            cluster.extend([(u'/a/', None), (u'/b/', u'B'), (u'/c/', None)])
+            cluster.freeze()
+            yield cluster
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'clusters.map')
+            with open(path, 'wb') as f:
+                f.write(pack_clusters([('a', cluster)]))
+            yield open_clusters(path)[0][1]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_partition(self):
+        for cluster in self.clusters():
+            found, missing = cluster.partition(['/b/', '/x/', '/a/', '/b/', '/x/', '/y/'])
+            self.assertEqual([term.value for term in found], [u'/b/', u'/a/'], cluster.storage)
+            self.assertEqual(missing, ['/x/', '/y/'])
+            self.assertEqual(cluster.partition([]), ([], []))
+
+            self.assertEqual([term.value for term in cluster.getTermsByTokens(['/c/', '/a/', '/c/'])],
+                             [u'/c/', u'/a/'])
+            try:
+                cluster.getTermsByTokens(['/a/', '/x/', '/y/', '/x/'])
+            except LookupError as e:
+                self.assertEqual(e.args, ('/x/', '/y/'))
+            else:
+                self.fail('unknown tokens were found')
+
+            self.assertTrue(cluster.containsAll([u'/a/', u'/c/', u'/a/']))
+            self.assertTrue(cluster.containsAll([]))
+            self.assertFalse(cluster.containsAll([u'/a/', u'/x/']))
+            self.assertFalse(cluster.containsAll([u'/a/', [u'/b/']]))
+
+
+class PagingTests(unittest.TestCase):
+
+    def make(self, storage, order):
+        cluster = CLUSTER_STORAGES[storage]('a')
+        cluster.order = order
+        cluster.extend([(u'/%02d/' % i, u'label %02d' % ((i * 7) % 23)) for i in range(23)])
+        return cluster
+
+    def pages(self, cluster, size):
+        pages = [cluster.page(0, size)]
+        while pages[-1]:
+            pages.append(cluster.pageAfter(pages[-1][-1].token, size))
+        return pages[:-1]
+
+    def test_pages(self):
+        for storage in CLUSTER_STORAGES:
+            for order in ('registration', 'label'):
+                cluster = self.make(storage, order)
+                terms = list(cluster) if order == 'registration' else cluster.ordered()
+                self.assertEqual(cluster.slice(5, 9), terms[5:9])
+                self.assertEqual(cluster.page(2, 10), terms[20:30])
+                self.assertEqual(cluster.page(3, 10), [])
+                pages = self.pages(cluster, 5)
+                self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 3])
+                self.assertEqual(sum(pages, []), terms, (storage, order))
+                self.assertRaises(LookupError, cluster.pageAfter, 'nope', 5)
+            self.assertEqual([term.title for term in cluster.page(0, 3)],
+                             [u'label 00', u'label 01', u'label 02'])
+
+
+class TokenTests(unittest.TestCase):
+
+    def make(self, storage, tokens, values):
+        cluster = CLUSTER_STORAGES[storage]('a')
+        cluster.tokens = tokens
+        cluster.extend([(value, None) for value in values])
+        return cluster
+
+    def test_digest(self):
+        values = [u'/path%d/' % i for i in range(200)]
+        for storage in CLUSTER_STORAGES:
+            cluster = self.make(storage, 'digest', values)
+            tokens = [term.token for term in cluster]
+            self.assertEqual(len(set(tokens)), len(values))
+            self.assertEqual(tokens, [term.token for term in self.make(storage, 'digest', values)])
+            for term in cluster:
+                self.assertEqual(len(term.token), 8)
+                self.assertEqual(cluster.getTermByToken(term.token).value, term.value)
+
+    def test_sequential(self):
+        for storage in CLUSTER_STORAGES:
+            cluster = self.make(storage, 'sequential', [u'/a/', u'/b/', u'/c/'])
+            self.assertEqual([term.token for term in cluster], ['0', '1', '2'])
+            self.assertEqual(cluster.getTermByToken('1').value, u'/b/')
+
+    def test_sequential_after_discard(self):
+        for storage in CLUSTER_STORAGES:
+            cluster = self.make(storage, 'sequential', [u'/a/', u'/b/', u'/c/'])
+            cluster.mutable = True
+            cluster.freeze()
+            cluster.discard([u'/b/'])
+            cluster.register(u'/d/')
+            self.assertEqual([term.token for term in cluster], ['0', '2', '3'])
+            self.assertRaises(LookupError, cluster.getTermByToken, '1')
+
+
+class OrderTests(SelectorTestCase):
+
+    def test_declared_orders(self):
+        self.configure('''
+            <selectorcluster name="a" order="label" storage="compact" mutable="true">
+                <selectorstring value="/c/" label="Beta" />
+                <selectorstring value="/a/" label="Gamma" />
+                <selectorstring value="/b/" label="Alpha" />
+                <selectorstring value="/d/" label="Beta" />
+            </selectorcluster>
+            <selectorcluster name="b" order="value">
+                <selectorstring value="/c/" label="Beta" />
+                <selectorstring value="/a/" label="Gamma" />
+                <selectorstring value="/b/" label="Alpha" />
+            </selectorcluster>''')
+        a, b = self.cluster('a'), self.cluster('b')
+        self.assertEqual(self.values(a), [u'/b/', u'/c/', u'/d/', u'/a/']) # ties as registered
+        self.assertEqual(self.values(b), [u'/a/', u'/b/', u'/c/'])
+        self.assertEqual([term.value for term in b.ordered('registration')],
+                         [u'/c/', u'/a/', u'/b/'])
+        self.assertEqual([term.value for term in b.ordered('label')], [u'/b/', u'/c/', u'/a/'])
+        self.assertEqual(len(b.ordered('label', 'en_US')), 3)
+        self.assertRaises(ValueError, b.ordered, 'size')
+
+        self.assertTrue(a.renderOptions().startswith(u'<option value="/b/">Alpha</option>'))
+        a.register(u'/e/', u'Aardvark')
+        self.assertEqual(self.values(a), [u'/e/', u'/b/', u'/c/', u'/d/', u'/a/'])
+        self.assertEqual([term.value for term in a.page(0, 2)], [u'/e/', u'/b/'])
+        self.assertTrue(a.renderOptions().startswith(u'<option value="/e/">Aardvark</option>'))
+        self.assertEqual([term.value for term in a.ordered('registration')],
+                         [u'/c/', u'/a/', u'/b/', u'/d/', u'/e/'])
+
+
+class RenderOptionsTests(unittest.TestCase):
+
+    def test_selected(self):
+        from xml.sax.saxutils import escape
+        selectors = [(u'/a/', u'A & B'), (u'/b"/', None), (u'/c/', u'C'), (u'/d/', u'<D>')]
+        for storage, cls in CLUSTER_STORAGES.items():
+            cluster = cls('a')
+            cluster.extend(selectors)
+            for selected in ((), [u'/a/'], [u'/d/', u'/a/', u'/c/'], [u'/c/', u'/c/'],
+                             [u'/nope/', [u'/a/'], u'/b"/'], [u'/a/', u'/b"/', u'/c/', u'/d/']):
+                expected = u''.join(
+                    u'<option%s value="%s">%s</option>\n' % (
+                        u' selected="selected"' if term.value in selected else u'',
+                        escape(term.token, {'"': '&quot;'}),
+                        escape(term.title))
+                    for term in cluster)
+                self.assertEqual(cluster.renderOptions(selected), expected, (storage, selected))
+
+
+class Clock(object):
+    """Stands in for the time module, telling a time set by the test.
+    """
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class DirectoryTests(SelectorTestCase):
+
+    def test_listing(self):
+        from . import directories
+        root = os.path.join(self.directory, 'docs')
+        for name in ('team-b', 'team-a', 'other', '.team-hidden'):
+            os.makedirs(os.path.join(root, name))
+        self.write('docs/team-file', b'')
+        os.utime(root, (1000000000, 1000000000))
+        self.configure('<selectordirectory cluster="a" directory="%s" pattern="team-*" ttl="60" />'
+                       % root)
+        cluster = self.cluster('a')
+        self.assertEqual(cluster._listing, None)
+
+        clock = Clock(2000000000.0)
+        time, directories.time = directories.time, clock
+        try:
+            self.assertEqual([(term.value, term.title) for term in cluster],
+                             [(os.path.join(root, 'team-a', ''), u'team-a'),
+                              (os.path.join(root, 'team-b', ''), u'team-b')])
+            listed = cluster._listing[0]
+
+            os.makedirs(os.path.join(root, 'team-c'))
+            os.utime(root, (1000000100, 1000000100))
+            clock.now += 59
+            self.assertEqual(len(cluster), 2) # within the ttl, not even checked
+
+            os.rmdir(os.path.join(root, 'team-c'))
+            os.utime(root, (1000000000, 1000000000))
+            clock.now += 2
+            self.assertEqual(len(cluster), 2)
+            self.assertTrue(cluster._listing[0] is listed) # unchanged, not listed again
+
+            os.makedirs(os.path.join(root, 'team-c'))
+            os.utime(root, (1000000200, 1000000200))
+            self.assertEqual(len(cluster), 2)
+            clock.now += 61
+            self.assertEqual(len(cluster), 3)
+            self.assertTrue(os.path.join(root, 'team-c', '') in cluster)
+            self.assertTrue(cluster._listing[0] is not listed)
+        finally:
+            directories.time = time
+        self.assertRaises(ValueError, cluster.register, u'/elsewhere/')
+
+
+class StartupCacheTests(SelectorTestCase):
+
+    def body(self, cache=True):
+        return '''
+            %s
+            <selectorstring cluster="a" value="/alpha/" label="Alpha" />
+            <selectorfile cluster="a" file="%s" />
+            <selectorstring cluster="a" value="/omega/" />
+            <selectorcluster name="b" storage="compact" tokens="digest">
+                <selectorstring value="/beta/" />
+            </selectorcluster>
+            ''' % ('<selectorcache file="%s" />' % os.path.join(self.directory, 'selectors.cache')
+                   if cache else '',
+                   self.write('a.csv', b'/gamma/,Gamma\n/delta/\n', mtime=1000000000))
+
+    def terms(self):
+        return [(term.value, term.token, term.title)
+                for name in ('a', 'b') for term in self.cluster(name)]
+
+    def configure_loading(self, body):
+        """Configure, returning whether the clusters were loaded from the cache.
+        """
+        from .startupcache import StartupCache
+        loaded = []
+        load = StartupCache.load
+        StartupCache.load = lambda cache: loaded.append(load(cache)) or loaded[-1]
+        try:
+            self.configure(body)
+        finally:
+            StartupCache.load = load
+        return loaded[0] is not None
+
+    def test_round_trip(self):
+        self.assertFalse(self.configure_loading(self.body()))
+        built = self.terms()
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'selectors.cache')))
+
+        self.cleanUp()
+        self.assertTrue(self.configure_loading(self.body()))
+        self.assertEqual(self.terms(), built)
+        self.assertEqual(self.cluster('b').storage, 'compact')
+        self.assertEqual(self.cluster('a').sources[-2][1:], ('csv', 1000000000, 2))
+
+    def test_order_unchanged(self):
+        self.configure(self.body(cache=False))
+        uncached = self.terms()
+        self.assertEqual([value for value, token, title in uncached],
+                         [u'/alpha/', u'/gamma/', u'/delta/', u'/omega/', u'/beta/'])
+        for loaded in (False, True):
+            self.cleanUp()
+            self.assertEqual(self.configure_loading(self.body()), loaded)
+            self.assertEqual(self.terms(), uncached, loaded)
+
+
+class VocabularyFactoryTests(CleanUp, unittest.TestCase):
+
+    def test_registered_directly(self):
+        from zope.component import getGlobalSiteManager
+        from .vocabulary import ClusterVocabularyFactory
+        registry = getGlobalSiteManager()
+        factory = ClusterVocabularyFactory(u'a')
+        self.assertEqual(factory(None), None)
+
+        cluster = CLUSTER_STORAGES['terms'](u'a')
+        registry.registerUtility(cluster, IClusterOfSelectors, u'a')
+        self.assertTrue(factory(None) is cluster)
+
+        other = CLUSTER_STORAGES['terms'](u'a')
+        registry.registerUtility(other, IClusterOfSelectors, u'a')
+        self.assertTrue(factory(None) is other)
+
+        registry.unregisterUtility(other, IClusterOfSelectors, u'a')
+        self.assertEqual(factory(None), None)
+
+    def test_registered_during_lookup(self):
+        from . import vocabulary
+        from .vocabulary import ClusterVocabularyFactory, provide_cluster
+        old, new = CLUSTER_STORAGES['terms'](u'a'), CLUSTER_STORAGES['terms'](u'a')
+        provide_cluster(old, u'a')
+        factory = ClusterVocabularyFactory(u'a')
+
+        def queryUtility(*args, **kw): # a reload swaps the cluster during the lookup
+            found = real(*args, **kw)
+            vocabulary.queryUtility = real
+            provide_cluster(new, u'a')
+            return found
+        real, vocabulary.queryUtility = vocabulary.queryUtility, queryUtility
+        try:
+            self.assertTrue(factory(None) is old)
+        finally:
+            vocabulary.queryUtility = real
+        self.assertTrue(factory(None) is new)
+
+    def test_local_site(self):
+        from zope.component import getGlobalSiteManager, getSiteManager
+        from zope.interface.registry import Components
+        from .vocabulary import ClusterVocabularyFactory, provide_cluster
+        default, local = CLUSTER_STORAGES['terms'](u'a'), CLUSTER_STORAGES['terms'](u'a')
+        provide_cluster(default, u'a')
+        factory = ClusterVocabularyFactory(u'a')
+        self.assertTrue(factory(None) is default)
+
+        site = Components('site', bases=(getGlobalSiteManager(),))
+        site.registerUtility(local, IClusterOfSelectors, u'a')
+        getSiteManager.sethook(lambda context=None: site)
+        try:
+            self.assertTrue(factory(None) is local)
+        finally:
+            getSiteManager.reset()
+        self.assertTrue(factory(None) is default)
+
+        getSiteManager.sethook(lambda context=None: Components('other', bases=(getGlobalSiteManager(),)))
+        try:
+            self.assertTrue(factory(None) is default)
+        finally:
+            getSiteManager.reset()
+
+
+class ReloadTests(SelectorTestCase):
+
+    def test_reload(self):
+        from .hotreload import reload_clusters
+        path = self.write('a.csv', b'/alpha/\n/beta/\n', mtime=1000000000)
+        self.configure('''
+            <selectorstring cluster="a" value="/first/" />
+            <selectorfile cluster="a" file="%s" />''' % path)
+        old = self.cluster('a')
+        self.assertEqual(reload_clusters(), [])
+
+        self.write('a.csv', b'/alpha/\n/new/\n/beta/\n', mtime=1000000100)
+        self.assertEqual(reload_clusters(), ['a'])
+        new = self.cluster('a')
+        self.assertTrue(new is not old and new.frozen)
+        self.assertEqual(self.values(new), [u'/first/', u'/alpha/', u'/new/', u'/beta/'])
+        self.assertEqual(self.values(old), [u'/first/', u'/alpha/', u'/beta/'])
+
+    def test_factory_follows(self):
+        from zope.schema.interfaces import IVocabularyFactory
+        from .hotreload import reload_clusters
+        path = self.write('a.csv', b'/alpha/\n', mtime=1000000000)
+        self.configure('<selectorfile cluster="a" file="%s" />' % path)
+        factory = getUtility(IVocabularyFactory, name=u'a')
+        self.assertEqual(self.values(factory(None)), [u'/alpha/'])
+
+        self.write('a.csv', b'/beta/\n', mtime=1000000100)
+        self.assertEqual(reload_clusters(), ['a'])
+        self.assertEqual(self.values(factory(None)), [u'/beta/'])
+
+
+class StressTests(unittest.TestCase):
+    """Reader threads see a mutable cluster whole while strings are registered.
+    """
+
+    def test_terms(self):
+        from .benchmark import stress_registration
+        self.assertEqual(stress_registration('terms', readers=4, strings=300), [])
+
+    def test_compact(self):
+        from .benchmark import stress_registration
+        self.assertEqual(stress_registration('compact', readers=4, strings=300), [])
+
+
+class LabelTests(SelectorTestCase):
+
+    def test_message_ids_shown_as_text(self):
+        from .jsonexport import cluster_json
+        for storage in CLUSTER_STORAGES:
+            self.cleanUp()
+            self.configure('''
+                <configure i18n_domain="tau.tests">
+                    <selectorcluster name="a" order="label" storage="%s">
+                        <selectorstring value="/old/" label="[archive] Old docs" />
+                        <selectorstring value="/new/" label="New docs" />
+                    </selectorcluster>
+                </configure>''' % storage)
+            cluster = self.cluster('a')
+            self.assertEqual(cluster.getTerm(u'/old/').title, u'archive')
+            self.assertEqual(cluster.renderOptions(),
+                             u'<option value="/new/">New docs</option>\n'
+                             u'<option value="/old/">Old docs</option>\n')
+            self.assertEqual([row['title'] for row in json.loads(cluster_json(cluster)[0])],
+                             [u'New docs', u'Old docs'])
+            self.assertEqual([term.value for term in cluster.search(u'old')], [u'/old/'])
+            self.assertEqual(cluster.search(u'arch'), [])
+
+
+class MappedTests(SelectorTestCase):
+
+    def test_round_trip(self):
+        from .sharedmemory import pack_clusters, open_clusters
+        clusters = []
+        for clustername, tokens, order in (('a', 'value', 'registration'), ('b', 'digest', 'label')):
+            cluster = CLUSTER_STORAGES['terms'](clustername)
+            cluster.tokens = tokens
+            cluster.order = order
+            cluster.extend([(u'/alpha/', u'Alpha'), (u'/b\xe9ta/', u'B\xe9ta'), (u'/gamma/', None)])
+            cluster.freeze()
+            clusters.append((clustername, cluster))
+        path = self.write('clusters.map', pack_clusters(clusters))
+
+        for (clustername, cluster), (mapped_name, mapped) in zip(clusters, open_clusters(path)):
+            self.assertEqual(mapped_name, clustername)
+            self.assertEqual(mapped.order, cluster.order)
+            self.assertEqual([(term.value, term.token, term.title) for term in mapped],
+                             [(term.value, term.token, term.title) for term in cluster])
+            for term in cluster:
+                self.assertEqual(mapped.getTerm(term.value).token, term.token)
+                self.assertEqual(mapped.getTermByToken(term.token).value, term.value)
+            self.assertFalse(u'/delta/' in mapped)
+            self.assertRaises(LookupError, mapped.getTermByToken, 'nope')
+
+
+class SharedMemoryTests(SelectorTestCase):
+
+    def provide(self, clustername, values):
+        from .vocabulary import provide_cluster
+        cluster = CLUSTER_STORAGES['terms'](clustername)
+        cluster.extend([(value, None) for value in values])
+        cluster.freeze()
+        provide_cluster(cluster, clustername)
+
+    def test_share(self):
+        from . import sharedmemory
+        path = os.path.join(self.directory, 'clusters.map')
+        self.provide(u'a', [u'/alpha/', u'/beta/'])
+        self.assertEqual(sharedmemory.share_clusters(path), [u'a'])
+        self.assertEqual(self.cluster(u'a').storage, 'mapped')
+        self.assertEqual(self.values(self.cluster(u'a')), [u'/alpha/', u'/beta/'])
+
+    def test_message_labels(self):
+        from zope.i18nmessageid import Message
+        self.configure('''
+            <configure i18n_domain="tau.tests">
+                <selectorstring cluster="a" value="/alpha/" label="[alpha] Alpha" />
+                <selectorstring cluster="a" value="/beta/" label="Beta" />
+                <selectorstring cluster="a" value="/gamma/" label="/gamma/" />
+                <selectorstring cluster="a" value="/delta/" />
+            </configure>
+            <selectorsharedmemory file="%s" />
+            ''' % os.path.join(self.directory, 'clusters.map'))
+
+        cluster = self.cluster(u'a')
+        self.assertEqual(cluster.storage, 'mapped')
+        titles = [cluster.getTerm(value).title
+                  for value in (u'/alpha/', u'/beta/', u'/gamma/', u'/delta/')]
+        self.assertEqual([type(title) for title in titles], [Message] * 3 + [type(u'')])
+        self.assertEqual([(title, title.domain, title.default) for title in titles[:3]],
+                         [(u'alpha', u'tau.tests', u'Alpha'), (u'Beta', u'tau.tests', None),
+                          (u'/gamma/', u'tau.tests', None)])
+        self.assertEqual([term.title for term in cluster.translated()],
+                         [u'Alpha', u'Beta', u'/gamma/', u'/delta/'])
+
+    def body(self, mutable='false'):
+        return '''
+            <selectorcache file="%s" />
+            <selectorsharedmemory file="%s" />
+            <selectorcluster name="a" order="label" mutable="%s">
+                <selectorstring value="/alpha/" label="Zeta" />
+                <selectorstring value="/private/" label="Private"
+                    interface="zope.interface.interfaces.IInterface" />
+            </selectorcluster>
+            <selectorfile cluster="b" file="%s" />
+            ''' % (os.path.join(self.directory, 'selectors.cache'),
+                   os.path.join(self.directory, 'clusters.map'), mutable,
+                   os.path.join(self.directory, 'b.csv'))
+
+    def configure_counting_loads(self, body):
+        from .startupcache import StartupCache
+        loads = []
+        load = StartupCache.load
+        StartupCache.load = lambda cache: loads.append(cache) or load(cache)
+        try:
+            self.configure(body)
+        finally:
+            StartupCache.load = load
+        return len(loads)
+
+    def test_mapped_before_building(self):
+        from zope.schema.interfaces import IVocabularyFactory
+        self.write('b.csv', b'/beta/\n/gamma/\n', mtime=1000000000)
+        self.assertEqual(self.configure_counting_loads(self.body()), 1)
+        built = [(name, [(term.value, term.token, term.title) for term in self.cluster(name)])
+                 for name in ('a', 'b')]
+
+        self.cleanUp()
+        self.assertEqual(self.configure_counting_loads(self.body()), 0)
+        for name, terms in built:
+            cluster = self.cluster(name)
+            self.assertEqual(cluster.storage, 'mapped')
+            self.assertFalse(cluster.restrictable)
+            self.assertEqual([(term.value, term.token, term.title) for term in cluster], terms)
+        self.assertEqual(self.values(self.cluster('a')), [u'/private/', u'/alpha/'])
+        factory = getUtility(IVocabularyFactory, name=u'a')
+        self.assertEqual(self.values(factory(object())), [u'/alpha/'])
+        self.assertRaises(ValueError, self.cluster('a').restrict, u'/alpha/', None, None)
+
+        self.cleanUp() # a changed data file is read, and shared again
+        self.write('b.csv', b'/delta/\n', mtime=1000000100)
+        self.assertEqual(self.configure_counting_loads(self.body()), 1)
+        self.assertEqual(self.values(self.cluster('b')), [u'/delta/'])
+        self.cleanUp()
+        self.assertEqual(self.configure_counting_loads(self.body()), 0)
+        self.assertEqual(self.values(self.cluster('b')), [u'/delta/'])
+
+    def test_built_unless_all_shared(self):
+        self.write('b.csv', b'/beta/\n', mtime=1000000000)
+        for run in ('first', 'second'):
+            self.cleanUp()
+            self.assertEqual(self.configure_counting_loads(self.body(mutable='true')), 1)
+            self.assertEqual(self.cluster('a').storage, 'terms')
+            self.assertEqual(self.cluster('b').storage, 'mapped')
+
+    def test_replaced_by_another_worker(self):
+        from . import sharedmemory
+        path = os.path.join(self.directory, 'clusters.map')
+        other = CLUSTER_STORAGES['terms'](u'a')
+        other.extend([(u'/other/', None)])
+        other.freeze()
+        self.write('clusters.map', sharedmemory.pack_clusters([(u'a', other)]))
+
+        # The file is replaced just after this worker found it held its clusters.
+        self.provide(u'a', [u'/alpha/', u'/beta/'])
+        current_digest = sharedmemory._current_digest
+        sharedmemory._current_digest = lambda path: sharedmemory.HEADER.unpack_from(
+            sharedmemory.pack_clusters([(u'a', self.cluster(u'a'))]), 0)[1]
+        try:
+            self.assertEqual(sharedmemory.share_clusters(path), [u'a'])
+        finally:
+            sharedmemory._current_digest = current_digest
+        self.assertEqual(self.values(self.cluster(u'a')), [u'/alpha/', u'/beta/'])
+
+
+class JSONExportTests(SelectorTestCase):
+
+    def setUp(self):
+        SelectorTestCase.setUp(self)
+        self.configure('''
+            <selectorcluster name="a" mutable="true">
+                <selectorstring value="/alpha/" label="Alpha" />
+                <selectorstring value="/beta/" />
+            </selectorcluster>''')
+
+    def request(self, path='/a', **environ):
+        from .jsonexport import ClusterJSONApplication
+        environ['PATH_INFO'] = path
+        response = []
+        body = ClusterJSONApplication()(environ, lambda *args: response.extend(args))
+        return response[0], dict(response[1]), b''.join(body)
+
+    def test_get(self):
+        status, headers, body = self.request()
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body.decode('ascii')),
+                         [{'value': u'/alpha/', 'token': u'/alpha/', 'title': u'Alpha'},
+                          {'value': u'/beta/', 'token': u'/beta/', 'title': u'/beta/'}])
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertFalse('Content-Encoding' in headers)
+
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH=headers['ETag'])[::2],
+                         ('304 Not Modified', b''))
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH='"other", %s' % headers['ETag'])[0],
+                         '304 Not Modified')
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH='"other"')[0], '200 OK')
+
+        self.cluster('a').register(u'/gamma/')
+        status, changed, body = self.request(HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '200 OK')
+        self.assertNotEqual(changed['ETag'], headers['ETag'])
+        self.assertEqual(len(json.loads(body.decode('ascii'))), 3)
+
+    def test_gzip(self):
+        import zlib
+        plain = self.request()
+        status, headers, body = self.request(HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), plain[2])
+        self.assertEqual(headers['ETag'], plain[1]['ETag'][:-1] + '-gzip"')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(self.request(HTTP_ACCEPT_ENCODING='gzip',
+                                      HTTP_IF_NONE_MATCH=headers['ETag'])[0], '304 Not Modified')
+        self.assertEqual(self.request(HTTP_ACCEPT_ENCODING='gzip',
+                                      HTTP_IF_NONE_MATCH=plain[1]['ETag'])[0], '200 OK')
+        self.assertFalse('Content-Encoding' in
+                         self.request(HTTP_ACCEPT_ENCODING='gzip;q=0, identity')[1])
+
+    def test_methods(self):
+        status, headers, body = self.request(REQUEST_METHOD='HEAD')
+        self.assertEqual((status, body), ('200 OK', b''))
+        self.assertEqual(headers['Content-Length'], str(len(self.request()[2])))
+        self.assertEqual(self.request(REQUEST_METHOD='POST')[0], '405 Method Not Allowed')
+        self.assertEqual(self.request('/nope')[0], '404 Not Found')
+        self.assertEqual(self.request('/')[0], '404 Not Found')
+
+
+class RestrictionTests(SelectorTestCase):
+
+    def setUp(self):
+        SelectorTestCase.setUp(self)
+        self.configure('''
+            <selectorstring cluster="a" value="/public/" />
+            <selectorstring cluster="a" value="/private/"
+                interface="zope.interface.interfaces.IInterface" />
+            ''')
+
+    def test_json_refused(self):
+        from .jsonexport import ClusterJSONApplication
+        statuses = []
+        body = ClusterJSONApplication()({'PATH_INFO': '/a'},
+                                        lambda status, headers: statuses.append(status))
+        self.assertEqual((statuses, body), (['403 Forbidden'], []))
+
+    def test_filtered_views_instrumented(self):
+        from zope.component import getUtility
+        from zope.schema.interfaces import IVocabularyFactory
+        from .instrumentation import enable_instrumentation, snapshot
+        factory = getUtility(IVocabularyFactory, name=u'a')
+        view = factory(object())
+        self.assertEqual(self.values(view), [u'/public/'])
+
+        enable_instrumentation()
+        self.assertEqual(factory(object()), view)
+        view.getTerm(u'/public/')
+        factory(IClusterOfSelectors).getTerm(u'/private/')
+        self.assertEqual(snapshot()[u'a']['calls']['getTerm'], 2)
+
+    def test_filtered_views_share_strings(self):
+        from zope.interface.interfaces import IInterface
+        from .sharedmemory import pack_clusters, open_clusters
+        compact = CLUSTER_STORAGES['compact']('b')
+        compact.extend([(u'/alpha/', u'Alpha'), (u'/beta/', u'Beta'), (u'/gamma/', None)])
+        compact.freeze()
+        path = self.write('clusters.map', pack_clusters([('b', compact)]))
+        compact.mutable = True
+        [(clustername, mapped)] = open_clusters(path)
+        mapped.restrictable = True
+
+        for cluster in (compact, mapped):
+            cluster.restrict(u'/beta/', interface=IInterface)
+            view = cluster.filtered(object())
+            self.assertEqual(self.values(view), [u'/alpha/', u'/gamma/'])
+            self.assertTrue(view._version.values.sequence is cluster._version.values)
+            self.assertEqual(len(view), 2)
+            self.assertFalse(u'/beta/' in view)
+            self.assertRaises(LookupError, view.getTerm, u'/beta/')
+            self.assertRaises(LookupError, view.getTermByToken, '/beta/')
+            self.assertEqual(view.getTermByToken('/gamma/').value, u'/gamma/')
+            self.assertEqual([term.value for term in view.search(u'/g')], [u'/gamma/'])
+            self.assertEqual(self.values(cluster.filtered(IClusterOfSelectors)),
+                             [u'/alpha/', u'/beta/', u'/gamma/'])
+
+
+class SearchTests(unittest.TestCase):
+
+    def test_built_when_searched(self):
+        for storage, cls in CLUSTER_STORAGES.items():
+            cluster = cls('a')
+            cluster.extend([(u'/Alpha/', u'First'), (u'/beta/', u'Fir')])
+            cluster.mutable = True
+            cluster.freeze()
+            self.assertFalse('search' in cluster._version.derived, storage)
+            self.assertEqual([term.value for term in cluster.search(u'fir')],
+                             [u'/beta/', u'/Alpha/'])
+            cluster.register(u'/alps/')
+            self.assertEqual([term.value for term in cluster.search(u'/al')],
+                             [u'/Alpha/', u'/alps/'])
+
+
+class DiscardTests(unittest.TestCase):
+
+    def test_discard(self):
+        for storage, cls in CLUSTER_STORAGES.items():
+            cluster = cls('a')
+            cluster.extend([(u'/a/', None), (u'/b/', None)])
+            cluster.extend([(u'/c/', None)], 'a.csv', 'csv', 1)
+            self.assertEqual(cluster.discard([u'/b/', u'/c/']), 2)
+            self.assertEqual([term.value for term in cluster], [u'/a/'], storage)
+            self.assertEqual(cluster.sources, [(None, None, None, 1), ('a.csv', 'csv', 1, 0)])
+            self.assertRaises(LookupError, cluster.getTerm, u'/b/')
+            self.assertEqual(cluster.search(u'/'), [cluster.getTerm(u'/a/')])
+
+    def test_cached_terms(self):
+        for mutable in (False, True):
+            cluster = CLUSTER_STORAGES['compact']('a')
+            cluster.extend([(u'/a/', None), (u'/b/', None), (u'/c/', None)])
+            if mutable:
+                cluster.mutable = True
+                cluster.freeze()
+            self.assertEqual(cluster.getTerm(u'/b/').value, u'/b/')
+            cluster.discard([u'/a/'])
+            self.assertEqual(cluster.getTerm(u'/c/').value, u'/c/')
+            self.assertEqual(cluster.getTermByToken('/b/').value, u'/b/')
+
+    def test_frozen(self):
+        cluster = CLUSTER_STORAGES['terms']('a')
+        cluster.extend([(u'/a/', None)])
+        cluster.freeze()
+        self.assertRaises(ValueError, cluster.discard, [u'/a/'])
+
+
+class ValidationTests(SelectorTestCase):
+
+    def test_flag(self):
+        os.mkdir(os.path.join(self.directory, 'docs'))
+        docs, missing = [os.path.join(self.directory, name) + '/' for name in ('docs', 'gone')]
+        self.configure('''
+            <selectorcluster name="a">
+                <selectorstring value="%s" label="Docs" />
+                <selectorstring value="%s" label="Gone" />
+            </selectorcluster>
+            <selectorvalidation clusters="a" invalid="flag" />''' % (docs, missing))
+        cluster = self.cluster('a')
+        self.assertEqual(self.values(cluster), [docs, missing])
+        self.assertEqual(cluster.invalid, {missing: 'missing'})
+        self.assertEqual(cluster.renderOptions([missing]),
+                         u'<option value="%s">Docs</option>\n'
+                         u'<option selected="selected" value="%s" disabled="disabled">Gone</option>\n'
+                         % (docs, missing))
+
+    def test_timeout(self):
+        import time
+        from . import validation
+        check_path = validation.check_path
+        validation.check_path = lambda path, kind: time.sleep(0.5) if path == '/slow/' else None
+        try:
+            problems = validation.check_paths(['/fast/', '/slow/'], threads=2, timeout=0.1)
+        finally:
+            validation.check_path = check_path
+        self.assertEqual(problems, {'/slow/': validation.TIMED_OUT})
+
+
+class SelectorFilesTests(SelectorTestCase):
+
+    def setUp(self):
+        SelectorTestCase.setUp(self)
+        os.mkdir(os.path.join(self.directory, 'teams'))
+        self.write('teams/b.csv', b'/b1/\n/b2/\n')
+        self.write('teams/a.csv', b'/a1/\n/a2/\n')
+        self.write('teams/c.jsonl', b'{"value": "/c1/"}\n')
+        self.write('extra.csv', b'/x1/\n')
+
+    def load(self, files, **attributes):
+        self.cleanUp()
+        self.configure('<selectorfiles cluster="a" files="%s" %s />' % (
+            ' '.join(os.path.join(self.directory, name) for name in files.split()),
+            ' '.join('%s="%s"' % attribute for attribute in sorted(attributes.items()))))
+        return self.values(self.cluster('a'))
+
+    def test_glob_order(self):
+        self.assertEqual(self.load('extra.csv teams/*.csv teams/a.csv teams/*.jsonl'),
+                         [u'/x1/', u'/a1/', u'/a2/', u'/b1/', u'/b2/', u'/c1/'])
+
+    def test_merged_in_order(self):
+        expected = [u'/c1/', u'/b1/', u'/b2/', u'/a1/', u'/a2/', u'/x1/']
+        for workers, processes in (('1', 'false'), ('4', 'false'), ('4', 'true')):
+            self.assertEqual(self.load('teams/c.jsonl teams/b.csv teams/a.csv extra.csv',
+                                       workers=workers, processes=processes),
+                             expected, (workers, processes))
+
+    def test_duplicates_named(self):
+        from zope.configuration.exceptions import ConfigurationError
+        path = self.write('teams/d.csv', b'/d1/\n/b2/\n')
+        try:
+            self.load('teams/*.csv')
+        except ConfigurationError as e:
+            self.assertTrue('%s: ' % path in str(e), str(e))
+        else:
+            self.fail('the duplicate of /b2/ was merged')
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
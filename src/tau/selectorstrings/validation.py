@@ -0,0 +1,189 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Checking, at startup, that the values of clusters of paths actually exist.
+
+   Many clusters hold filesystem paths, and a path on a missing mount would
+   otherwise go unnoticed until someone picks it.  Given the directive::
+
+      <selectorvalidation clusters="sitevids sitedocs" invalid="flag" />
+
+   every value of the named clusters is checked, once configuration is
+   complete but before the clusters are frozen, to exist, to be a directory
+   or a file as required, and to be readable.  A value ending in a slash must
+   be a directory.  The problems found are written to the log in a single
+   summary and, as asked, the invalid values are also flagged, in the
+   'invalid' dictionary of their cluster, or dropped from it altogether.
+   Flagged values stay in the cluster, but are offered disabled by its
+   renderOptions(); any other use of the cluster must check the dictionary.
+
+   Since each check may wait on a network filesystem, the paths are checked
+   concurrently by a pool of threads, each distinct path only once however
+   many clusters hold it, and any check not done within the timeout is
+   reported as such rather than holding up the start any longer.
+"""
+import os
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as clock
+
+from zope.component import queryUtility
+
+from .interfaces import IClusterOfSelectors
+from .zcml_directives import ClusterOfSelectors, FREEZE_ORDER
+
+import logging
+log = logging.getLogger("tau.selectorstrings")
+
+INVALID_ACTIONS = ('log', 'flag', 'drop')
+
+TIMED_OUT = 'timed out'
+
+SUMMARY_EXAMPLES = 20 # the invalid values named in the summary, at most
+
+
+def check_path(path, kind=None):
+    """Return the problem with a path, or None if it is fine.
+
+       The kind is 'directory' or 'file', or None for either, unless the path
+       ends in a slash and so must be a directory.
+    """
+
+    if kind is None and path.endswith(('/', os.sep)):
+        kind = 'directory'
+    try:
+        if not os.path.exists(path):
+            return 'missing'
+        if kind == 'directory' and not os.path.isdir(path):
+            return 'not a directory'
+        if kind == 'file' and not os.path.isfile(path):
+            return 'not a file'
+        mode = os.R_OK | os.X_OK if os.path.isdir(path) else os.R_OK
+        if not os.access(path, mode):
+            return 'unreadable'
+    except (OSError, TypeError, ValueError) as e:
+        return 'unusable (%s)' % e
+    return None
+
+
+def check_paths(paths, kind=None, threads=32, timeout=10.0):
+    """Check many paths concurrently, returning the problem of each invalid one.
+
+       Any path whose check is not done within the timeout, in seconds, of
+       starting is reported as timed out.  The threads checking such paths
+       are abandoned, as they cannot be interrupted, rather than waited for.
+    """
+
+    paths = list(paths)
+    if not paths:
+        return {}
+
+    workers = ThreadPool(min(threads, len(paths)))
+    try:
+        started = clock()
+        pending = [(path, workers.apply_async(check_path, (path, kind))) for path in paths]
+        problems = {}
+        for path, result in pending:
+            try:
+                problem = result.get(max(0.0, started + timeout - clock()))
+            except TimeoutError:
+                problem = TIMED_OUT
+            if problem is not None:
+                problems[path] = problem
+    finally:
+        workers.close()
+    if TIMED_OUT not in problems.values():
+        workers.join()
+    return problems
+
+
+def validate_clusters(clusternames, kind=None, invalid='log', threads=32, timeout=10.0):
+    """Check the values of some clusters, logging a summary of those invalid.
+
+       As asked by invalid, the invalid values are then also flagged, in the
+       'invalid' dictionary of each cluster, or dropped from it.  Returns the
+       problem of each invalid value, by clustername and then value.
+    """
+
+    if invalid not in INVALID_ACTIONS:
+        raise ValueError("Unknown handling %r of invalid selectors" % invalid)
+
+    clusters = []
+    for clustername in clusternames:
+        cluster = queryUtility(IClusterOfSelectors, name=clustername)
+        if not isinstance(cluster, ClusterOfSelectors):
+            log.warning("Not validating %r, which is not a cluster of selectorstrings"
+                        % clustername)
+            continue
+        clusters.append((clustername, cluster))
+
+    paths = set()
+    for clustername, cluster in clusters:
+        paths.update(term.value for term in cluster.ordered('registration'))
+
+    started = clock()
+    problems = check_paths(sorted(paths), kind, threads, timeout)
+    elapsed = clock() - started
+
+    report = {}
+    for clustername, cluster in clusters:
+        report[clustername] = found = dict(
+            (term.value, problems[term.value])
+            for term in cluster.ordered('registration') if term.value in problems)
+        if invalid == 'flag':
+            cluster.flag(found)
+        elif invalid == 'drop' and found:
+            if cluster.frozen and not cluster.mutable: # as when mapped from a shared file
+                log.warning("Cannot drop the invalid values of the shared cluster %r, "
+                            "which are flagged instead" % clustername)
+                cluster.flag(found)
+            else:
+                cluster.discard(found)
+
+    counts = {}
+    for problem in problems.values():
+        counts[problem] = counts.get(problem, 0) + 1
+    summary = "Validated %d paths of %d clusters in %.2fs: " % (
+        len(paths), len(clusters), elapsed)
+    if not problems:
+        log.info(summary + "all valid")
+        return report
+
+    examples = sorted(problems.items())[:SUMMARY_EXAMPLES]
+    log.warning(summary + "%s%s\n%s" % (
+        ', '.join('%d %s' % (count, problem) for problem, count in sorted(counts.items())),
+        {'log': '', 'flag': ', which are flagged', 'drop': ', which are dropped'}[invalid],
+        '\n'.join('  %r: %s' % example for example in examples)
+        + ('\n  ...' if len(problems) > len(examples) else '')))
+    return report
+
+
+def selectorvalidation_SimpleDirectiveHandler(_context, clusters, kind=None, invalid='log',
+                                              threads=32, timeout=10.0):
+    """Handler of a simple ZCML directive validating the paths held by clusters.
+    """
+
+    def deferred__validate_clusters(clusternames, kind, invalid, threads, timeout):
+        """The actual handling that is performed at the -END- of configuration.
+
+           Validate the clusters once they are complete, but before they are
+           frozen, so that invalid values can still be dropped.
+        """
+        validate_clusters(clusternames, kind, invalid, threads, timeout)
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorvalidation', tuple(clusters)),  # must be unique!
+        callable=deferred__validate_clusters,
+        args=(tuple(clusters), kind, invalid, threads, timeout),
+        order=FREEZE_ORDER - 1, # after the startup cache, whose directive comes first, is saved
+        )
@@ -0,0 +1,118 @@
+##############################################################################
+#
+# Copyright (c) 2010 Tau Productions Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""The vocabulary factory through which Zope obtains a cluster.
+
+   Because of the way Zope vocabularies work, a widget does not look up a
+   cluster directly but calls a factory utility, registered under the name
+   of the cluster, passing it the context within which the vocabulary is
+   wanted.  That factory is called on every render of every widget using the
+   vocabulary, so rather than look the cluster up in the global registry
+   each time, it holds on to the cluster and looks it up again only after
+   some cluster has since been registered or unregistered.  Within a local
+   site, which may hold a cluster of its own under the name, the cluster is
+   still looked up on every call.
+"""
+import zope.event
+from zope.interface import implements
+from zope.interface.interfaces import IRegistrationEvent, IUtilityRegistration
+from zope.component import queryUtility, provideUtility
+from zope.component import getSiteManager, getGlobalSiteManager
+from zope.schema.interfaces import IVocabularyFactory
+
+from .interfaces import IClusterOfSelectors
+
+####
+# A count of the times any cluster has been registered or unregistered.  A
+# factory whose cluster was looked up at an older generation looks it up again.
+
+_generation = 0
+
+
+def registry_changed():
+    """Note that the clusters in the registry may have changed.
+    """
+    global _generation
+    _generation += 1
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(registry_changed) # the registry is emptied between tests
+
+
+def cluster_registration_changed(event):
+    """Note the registration, or unregistration, of a cluster in any registry.
+
+       Subscribed to every event, rather than through the registry, so that
+       it is notified of registrations in local sites too, and from the start.
+       zope.component.provideUtility() sends no event, so clusters provided
+       that way must be provided through provide_cluster() instead.
+    """
+    if (IRegistrationEvent.providedBy(event)
+            and IUtilityRegistration.providedBy(event.object)
+            and event.object.provided.isOrExtends(IClusterOfSelectors)):
+        registry_changed()
+
+zope.event.subscribers.append(cluster_registration_changed)
+
+
+def provide_cluster(cluster, clustername):
+    """Provide a cluster to the registry under its name, as a utility.
+    """
+    provideUtility(cluster, provides=IClusterOfSelectors, name=clustername)
+    registry_changed()
+
+
+class ClusterVocabularyFactory(object):
+    """A factory that returns the cluster of a given name as a vocabulary.
+
+       The factory does not actually *create* a cluster object, but returns
+       the one registered under its name, as filtered for the context passed
+       by Zope should any of its selectorstrings be restricted to some
+       contexts only.
+
+       Outside of any local site the cluster is held, and looked up again
+       only once some cluster has been registered or unregistered.  Within a
+       local site it is looked up on every call, as the cluster held is that
+       of the global registry only.
+    """
+    implements(IVocabularyFactory)
+
+    def __init__(self, clustername, cluster=None):
+        self.clustername = clustername
+        self._cluster = cluster
+        self._generation = _generation if cluster is not None else -1
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.clustername)
+
+    def __call__(self, context):
+        if getSiteManager() is getGlobalSiteManager():
+            if self._generation != _generation:
+                # Take the generation before looking up the cluster, so that
+                # should another be registered meanwhile it is looked up again
+                # at the next call, and store the cluster before the generation,
+                # so that another thread seeing the new generation also sees it.
+                generation = _generation
+                self._cluster = queryUtility(IClusterOfSelectors, name=self.clustername)
+                self._generation = generation
+            cluster = self._cluster
+        else: # a local site, which may hold a cluster of its own
+            cluster = queryUtility(IClusterOfSelectors, name=self.clustername)
+        filtered = getattr(cluster, 'filtered', None)
+        if filtered is None:
+            return cluster
+        return filtered(context)
@@ -43,6 +43,11 @@
           <selectorstring label="Family Photos", value="/home/jeff/photos" />
       </selectorcluster>
 
+   A third, simple directive loads a large cluster from a data file rather
+   than from one directive per string::
+
+      <selectorfile cluster="sitedocs" file="sitedocs.csv" />
+
    And then you reference the declared strings as a Zope vocabulary named with
    the cluster name using a Choice-type of schema dropdown widget::
 
@@ -51,13 +56,40 @@
           sitedocs = Choice(title=u"Path to Site Documents",
                             vocabulary="sitedocs")
 """
-from zope.interface import implements, alsoProvides
-from zope.component import queryUtility, provideUtility
+import os
+import glob
+import threading
+from base64 import b32encode
+from hashlib import sha1
+from array import array
+from bisect import bisect_left
+from timeit import default_timer as clock
+from xml.sax.saxutils import escape
+
+from zope.interface import implements
+from zope.component import queryUtility, provideUtility, getUtilitiesFor
 from zope.schema.vocabulary import SimpleTerm, SimpleVocabulary
-from zope.schema.interfaces import IVocabularyFactory
+from zope.schema.interfaces import IVocabularyFactory, ITitledTokenizedTerm
+from zope.configuration.exceptions import ConfigurationError
+
+try:
+    from zope.security import checkPermission
+except ImportError:
+    checkPermission = None # and so every permission is denied
+
+try:
+    from zope.i18n import translate, negotiate
+except ImportError:
+    translate = negotiate = None # and so labels are shown untranslated
+from zope.i18nmessageid import Message
 
 from .interfaces import (
     ISelectorStringDirective, ISelectorClusterDirective, IClusterOfSelectors)
+from .datafiles import guess_format, iter_selectors, read_many_selectors, text_type
+from .startupcache import StartupCache
+from .vocabulary import ClusterVocabularyFactory, provide_cluster
+from .collation import collation_key
+from .interning import pool
 
 ####
 # Provide a logging instance for producing error or status messages into the
@@ -67,8 +99,463 @@ from .interfaces import (
 import logging
 log = logging.getLogger("tau.selectorstrings")
 
+QUOTE_ENTITIES = {'"': '&quot;'} # for escaping of attribute values
+
+
+def label_text(title):
+    """Return the text shown for a title when it is not translated.
+
+       That of an i18n message id is its default, as given by a label of
+       the form "[id] text", or else the message id itself.
+    """
+
+    if isinstance(title, Message) and title.default is not None:
+        return title.default
+    return title
+
+
+class LRUCache(object):
+    """A mapping of at most some number of entries, evicting the least recently used.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = {} # (tick of last use, value) by key
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._tick += 1
+            self._entries[key] = (self._tick, entry[1])
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.size:
+                oldest = min(self._entries, key=lambda key: self._entries[key][0])
+                del self._entries[oldest]
+            self._tick += 1
+            self._entries[key] = (self._tick, value)
+            return value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def values(self):
+        with self._lock:
+            return [value for tick, value in self._entries.values()]
+
+
+def context_allows(context, permission=None, interface=None):
+    """Return whether a context satisfies the predicate of a selectorstring.
+    """
+
+    if interface is not None and not interface.providedBy(context):
+        return False
+    if permission is not None:
+        if checkPermission is None or not checkPermission(permission, context):
+            return False
+    return True
+
+
+def establish_cluster(clustername, storage=None, **settings):
+    """Return the 'cluster' object for a clustername, creating it if need be.
+
+       The 'cluster' object is created, and registered as a utility, the
+       first time we ever see a particular clustername used.  It is called
+       only from the deferred actions, at the -END- of configuration.
+
+       The storage names the layout, from CLUSTER_STORAGES, in which a newly
+       created cluster keeps its strings, and any other settings, such as its
+       tokens or order, those that are not None of its attributes named in
+       ClusterOfSelectors.settings.  An existing cluster keeps its own.
+    """
+
+    cluster = queryUtility(IClusterOfSelectors, name=clustername)
+    if cluster is None: # first time this clustername has been seen
+        log.info("No such cluster as %r, creating one" % clustername)
+
+        cluster = CLUSTER_STORAGES[storage or 'terms'](clustername)
+        for name, setting in settings.items():
+            if setting is not None:
+                setattr(cluster, name, setting)
+        provide_cluster(cluster, clustername)
+
+        # Because of the way Zope vocabularies work, we also need a
+        # factory utility that gets called to obtain the cluster object.
+        # This use of a factory to indirectly provide the cluster is
+        # necessary because Zope wants to pass to us the context within
+        # which the vocabulary is being created.  In our case we don't
+        # -need- this context but we have to accept it anyway.  Our
+        # factory does not actually *create* a cluster object but instead
+        # holds on to the one registered under its name and returns it.
+
+        provideUtility(ClusterVocabularyFactory(clustername, cluster),
+                       provides=IVocabularyFactory, name=clustername)
+
+    elif storage is not None and cluster.storage != storage:
+        log.warning("Cluster %r was already created with another storage than %r"
+                    % (clustername, storage))
+    else:
+        for name, setting in sorted(settings.items()):
+            if setting is not None and getattr(cluster, name, setting) != setting:
+                log.warning("Cluster %r was already created with another %s than %r"
+                            % (clustername, name, setting))
+
+    return cluster
+
+
+def configuration_machine(_context):
+    """Return the outermost context of the configuration process.
+
+       Each directive handler is passed a context of its own, nested within
+       those of any enclosing directives, whereas state that must outlive a
+       single directive is kept on the outermost one.
+    """
+
+    machine = _context
+    while 'context' in machine.__dict__:
+        machine = machine.context
+    return machine
+
+
+####
+# Once configuration is over nothing should change a cluster again, so every
+# handler arranges, the first time any of them is called, for an action that
+# freezes all the clusters.  Its order places it after all other actions.
+# Another action, before all others, opens the pool in which the strings of
+# the clusters are interned, which is closed once they are frozen.
+
+FREEZE_ORDER = 10000
+
+
+def schedule_freeze(_context):
+    """Arrange for all clusters to be frozen at the very -END- of configuration.
+    """
+
+    machine = configuration_machine(_context)
+    if machine.__dict__.get('selectorstrings_freeze_scheduled'):
+        return
+    machine.selectorstrings_freeze_scheduled = True
+
+    def deferred__freeze_clusters():
+        """The actual handling that is performed at the -END- of configuration.
+        """
+        try:
+            for clustername, cluster in getUtilitiesFor(IClusterOfSelectors):
+                cluster.freeze()
+        finally:
+            pool.close()
+
+    _context.action( # register an action to occur before all the others
+        discriminator=('selectorstrings-intern',),  # must be unique!
+        callable=pool.open,
+        order=-FREEZE_ORDER - 1,
+        )
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorstrings-freeze',),  # must be unique!
+        callable=deferred__freeze_clusters,
+        order=FREEZE_ORDER,
+        )
+
+
+####
+# When a <selectorcache> directive is given, ahead of all the others, the
+# resolved clusters are cached on disk along with a fingerprint of every file
+# that contributed to them.  Every handler records its ZCML file, and any data
+# file, as such a source.  Should the fingerprint still match at the next
+# start, the clusters are loaded from the cache by an action ordered before
+# all others and the actions that would otherwise build them do nothing.
+
+def selectorcache_SimpleDirectiveHandler(_context, file):
+    """Handler of a simple ZCML directive that enables the startup cache.
+    """
+
+    machine = configuration_machine(_context)
+    if machine.__dict__.get('selectorstrings_freeze_scheduled'):
+        raise ConfigurationError(
+            "The <selectorcache> directive must come before any other "
+            "selector directive")
+    if machine.__dict__.get('selectorstrings_cache') is not None:
+        raise ConfigurationError(
+            "Only one <selectorcache> directive may be given")
+    cache = machine.selectorstrings_cache = StartupCache(file)
+
+    def deferred__load_cache(cache):
+        """The actual handling that is performed at the -START- of the actions.
+        """
+
+        if cache.loaded: # the clusters were mapped from a file shared by another worker
+            return
+        clusters = cache.load()
+        if clusters is None:
+            return
+        cache.loaded = True
+
+        for clustername, storage, settings, selectors, sources in clusters:
+            cluster = establish_cluster(clustername, storage, **settings)
+            start = 0
+            for path, format, mtime, count in sources:
+                cluster.extend(selectors[start:start + count], path, format, mtime)
+                start += count
+        log.info("Loaded %d clusters from selector cache %r"
+                 % (len(clusters), cache.path))
+
+    def deferred__save_cache(cache):
+        """The actual handling that is performed at the -END- of configuration.
+        """
+
+        if cache.loaded:
+            return
+
+        clusters = []
+        for clustername, cluster in getUtilitiesFor(IClusterOfSelectors):
+            if not isinstance(cluster, ClusterOfSelectors):
+                continue # not a cluster built by these directives
+            selectors = tuple(
+                (term.value, None if term.title is term.value else term.title)
+                for term in cluster.ordered('registration'))
+            settings = dict((name, getattr(cluster, name)) for name in cluster.settings)
+            clusters.append((clustername, cluster.storage, settings, selectors,
+                             tuple(cluster.sources)))
+        cache.save(tuple(clusters))
+
+    _context.action( # register an action to occur at the start of the actions
+        discriminator=('selectorcache', 'load'),  # must be unique!
+        callable=deferred__load_cache,
+        args=(cache,),
+        order=-FREEZE_ORDER,
+        )
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorcache', 'save'),  # must be unique!
+        callable=deferred__save_cache,
+        args=(cache,),
+        order=FREEZE_ORDER - 1,
+        )
+
+
+def record_sources(_context, *paths):
+    """Record the ZCML file of a directive, and any data files, with the cache.
+
+       Returns the startup cache, or None if there is none.
+    """
+
+    cache = configuration_machine(_context).__dict__.get('selectorstrings_cache')
+    if cache is not None:
+        cache.addSource(_context.info.file)
+        for path in paths:
+            cache.addSource(path)
+    return cache
+
+
+####
+# Normally each selectorstring registers an action of its own, which is fine
+# for a handful of strings but for many thousands means as many discriminators
+# for zope.configuration to conflict-resolve and as many registry lookups of
+# the cluster.  When the following feature is provided, ahead of the
+# directives, by a <meta:provides feature="selectorstrings-accumulate" />
+# the selectorstrings are instead accumulated per cluster during parsing and
+# registered in bulk by one action per cluster, or rather per run of them
+# between the data files of the cluster, so that their order is unchanged.
+#
+# The price is that identical selectorstrings are no longer detected as
+# conflicting actions, nor can they be overridden using includeOverrides.
+
+ACCUMULATE_FEATURE = 'selectorstrings-accumulate'
+
+
+def accumulated_selectors(_context, clustername):
+    """Return the list into which selectorstrings for a cluster accumulate.
+
+       The first time a clustername is seen during the configuration process
+       a list is created and a single action registered that, at the -END- of
+       configuration, bulk-registers everything accumulated into that list.
+       Should another action adding to the cluster be registered meanwhile,
+       such as that of a data file, a further list and action are begun for
+       the selectorstrings that follow it, so that their order is kept.
+    """
+
+    machine = configuration_machine(_context)
+    buffers = machine.__dict__.setdefault('selectorstring_buffers', {})
+
+    selectors = buffers.get(clustername)
+    if selectors is None: # first time this clustername has been seen, or since interrupted
+        selectors = buffers[clustername] = []
+        counts = machine.__dict__.setdefault('selectorstring_buffer_counts', {})
+        count = counts[clustername] = counts.get(clustername, 0) + 1
+
+        def deferred__register_accumulated(clustername, selectors, cache):
+            """The actual handling that is performed at the -END- of configuration.
+            """
+            if cache is not None and cache.loaded:
+                return
+            cluster = establish_cluster(clustername)
+            cluster.extend(selectors)
+
+        _context.action( # register an action to occur at the end of the configuration process
+            discriminator=('selectorstrings', clustername, count),  # must be unique!
+            callable=profiled_action(_context, clustername, deferred__register_accumulated),
+            args=(clustername, selectors, machine.__dict__.get('selectorstrings_cache')),
+            )
+
+    return selectors
 
-def selectorstring_SimpleDirectiveHandler(_context, cluster, value, label=None):
+
+def interrupt_accumulation(_context, clustername):
+    """Note that an action adding to a cluster follows any selectorstrings so far.
+
+       Those accumulated until now are kept apart from those that follow, which
+       begin a list of their own, registered after the interrupting action.
+    """
+
+    buffers = configuration_machine(_context).__dict__.get('selectorstring_buffers')
+    if buffers:
+        buffers.pop(clustername, None)
+
+
+####
+# To find where startup time goes, the following feature, when provided ahead
+# of the directives by a <meta:provides feature="selectorstrings-profile" />
+# times every call of the selector directive handlers and of the deferred
+# actions they register, by ZCML file and by cluster, and logs a report of
+# them, slowest first, at the -END- of configuration.
+
+PROFILE_FEATURE = 'selectorstrings-profile'
+
+
+class ConfigurationProfile(object):
+    """The calls and seconds taken by each (ZCML file, cluster, handler/action).
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    def record(self, file, clustername, phase, seconds):
+        key = (file, clustername, phase)
+        calls, total = self.timings.get(key, (0, 0.0))
+        self.timings[key] = (calls + 1, total + seconds)
+
+    def report(self):
+        """Log the timings, and the total of each ZCML file, slowest first.
+        """
+
+        files = {}
+        for (file, clustername, phase), (calls, seconds) in self.timings.items():
+            files[file] = files.get(file, 0.0) + seconds
+
+        log.info("Selector configuration profile, slowest first:")
+        for file, seconds in sorted(files.items(), key=lambda item: -item[1]):
+            log.info("  %9.6fs  %s" % (seconds, file))
+        for (file, clustername, phase), (calls, seconds) in sorted(
+                self.timings.items(), key=lambda item: -item[1][1]):
+            log.info("  %9.6fs %7d calls  %s  cluster %r  %s"
+                     % (seconds, calls, file, clustername, phase))
+
+
+def configuration_profile(_context):
+    """Return the profile of the configuration process, or None if not profiling.
+    """
+
+    if not _context.hasFeature(PROFILE_FEATURE):
+        return None
+
+    machine = configuration_machine(_context)
+    profile = machine.__dict__.get('selectorstrings_profile')
+    if profile is None:
+        profile = machine.selectorstrings_profile = ConfigurationProfile()
+
+        _context.action( # register an action to occur after all the others
+            discriminator=('selectorstrings-profile',),  # must be unique!
+            callable=profile.report,
+            order=FREEZE_ORDER + 1,
+            )
+    return profile
+
+
+def profiled(handler):
+    """Decorate a directive handler, or a method handling a subdirective, to be timed.
+
+       Handlers are called with the context as their last positional argument
+       and the attributes of the directive as keywords, which name the cluster
+       unless it is that of the complex directive handling the subdirective.
+    """
+
+    def profiled_handler(*args, **kw):
+        _context = args[-1]
+        profile = configuration_profile(_context)
+        if profile is None:
+            return handler(*args, **kw)
+
+        if len(args) > 1: # a method of the complex directive handler
+            clustername = kw.get('name', getattr(args[0], 'name', None))
+            phase = '%s.%s' % (type(args[0]).__name__, handler.__name__)
+        else:
+            clustername = kw.get('cluster')
+            phase = handler.__name__
+
+        started = clock()
+        try:
+            return handler(*args, **kw)
+        finally:
+            profile.record(_context.info.file, clustername, phase, clock() - started)
+
+    profiled_handler.__name__ = handler.__name__
+    profiled_handler.__doc__ = handler.__doc__
+    return profiled_handler
+
+
+def profiled_action(_context, clustername, callable):
+    """Return the callable of an action, timed if profiling.
+    """
+
+    profile = configuration_profile(_context)
+    if profile is None:
+        return callable
+    file = _context.info.file
+
+    def profiled_callable(*args, **kw):
+        started = clock()
+        try:
+            return callable(*args, **kw)
+        finally:
+            profile.record(file, clustername, callable.__name__, clock() - started)
+
+    return profiled_callable
+
+
+def restrict_selector(_context, clustername, value, permission, interface):
+    """Register an action restricting a selectorstring to some contexts only.
+
+       Its order places it after the actions registering the selectorstrings,
+       whether one by one, accumulated or from the startup cache.
+    """
+
+    if permission is None and interface is None:
+        return
+
+    def deferred__restrict_selector(clustername, value, permission, interface):
+        """The actual handling that is performed at the -END- of configuration.
+        """
+        cluster = establish_cluster(clustername)
+        cluster.restrict(value, permission, interface)
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorstring-restrict', clustername, value),  # must be unique!
+        callable=deferred__restrict_selector,
+        args=(clustername, value, permission, interface),
+        order=1,
+        )
+
+
+@profiled
+def selectorstring_SimpleDirectiveHandler(_context, cluster, value, label=None,
+                                          permission=None, interface=None):
     """Handler of a simple ZCML directive.
 
        NOTE: A handler does NOT execute an action immediately but instead
@@ -82,7 +569,15 @@ def selectorstring_SimpleDirectiveHandler(_context, cluster, value, label=None):
        have been automatically validated by Zope against the directive's schema.
     """
 
-    def deferred__append_selector(_context, clustername, value, label):
+    schedule_freeze(_context)
+    cache = record_sources(_context)
+    restrict_selector(_context, cluster, value, permission, interface)
+
+    if _context.hasFeature(ACCUMULATE_FEATURE):
+        accumulated_selectors(_context, cluster).append((value, label))
+        return
+
+    def deferred__append_selector(_context, clustername, value, label, cache):
         """The actual handling that is performed at the -END- of configuration.
 
            Append each selectorstring, as it is parsed from a ZCML file, onto
@@ -94,35 +589,128 @@ def selectorstring_SimpleDirectiveHandler(_context, cluster, value, label=None):
            list with each string being a pick value on that dropdown.
         """
 
-        cluster = queryUtility(IClusterOfSelectors, name=clustername)
-        if cluster is None: # first time this clustername has been seen
-            log.info("No such cluster as %r, creating one" % clustername)
+        if cache is not None and cache.loaded:
+            return
+        cluster = establish_cluster(clustername)
+        cluster.register(value, label)
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorstring', cluster, value, label),  # must be unique!
+        callable=profiled_action(_context, cluster, deferred__append_selector),
+        args=(_context, cluster, value, label, cache),
+        )
 
-            cluster = ClusterOfSelectors(clustername)
-            provideUtility(cluster, provides=IClusterOfSelectors, name=clustername)
 
-            # Because of the way Zope vocabularies work, we also need a
-            # factory utility that gets called to obtain the cluster object.
-            # This use of a factory to indirectly provide the cluster is
-            # necessary because Zope wants to pass to us the context within
-            # which the vocabulary is being created.  In our case we don't
-            # -need- this context but we have to accept it anyway.  Our
-            # factory does not actually *create* a cluster object but instead
-            # just looks it up and returns it.
+@profiled
+def selectorfile_SimpleDirectiveHandler(_context, cluster, file, format=None,
+                                        storage=None, tokens=None, order=None,
+                                        collation=None):
+    """Handler of a simple ZCML directive that loads a whole data file.
 
-            def SelectorFactory(context):
-                cluster = queryUtility(IClusterOfSelectors, name=clustername)
-                return cluster
-            alsoProvides(SelectorFactory, IVocabularyFactory)
+       Unlike <selectorstring>, the rows of the data file do not pass through
+       the ZCML parser nor get validated against a schema, and only a single
+       action is registered for the entire file rather than one per row.  The
+       file is not read until that action is performed, at the end of the
+       configuration process, and even then it is streamed one row at a time
+       straight into the cluster.
+    """
 
-            provideUtility(SelectorFactory, provides=IVocabularyFactory, name=clustername)
+    if format is None:
+        format = guess_format(file)
+        if format is None:
+            raise ConfigurationError(
+                "Cannot guess the format of selector file %r, "
+                "please give a format= attribute" % file)
 
-        cluster.register(value, label)
+    schedule_freeze(_context)
+    cache = record_sources(_context, file)
+    interrupt_accumulation(_context, cluster)
+
+    def deferred__load_selectorfile(clustername, path, format, storage, settings, cache):
+        """The actual handling that is performed at the -END- of configuration.
+
+           Stream every row of the data file onto the 'cluster' object for
+           the clustername.
+        """
+
+        if cache is not None and cache.loaded:
+            return
+        cluster = establish_cluster(clustername, storage, **settings)
+        cluster.extend(iter_selectors(path, format), path, format)
 
     _context.action( # register an action to occur at the end of the configuration process
-        discriminator=('selectorstring', cluster, value, label),  # must be unique!
-        callable=deferred__append_selector,
-        args=(_context, cluster, value, label),
+        discriminator=('selectorfile', cluster, file),  # must be unique!
+        callable=profiled_action(_context, cluster, deferred__load_selectorfile),
+        args=(cluster, file, format, storage,
+              dict(tokens=tokens, order=order, collation=collation), cache),
+        )
+
+
+@profiled
+def selectorfiles_SimpleDirectiveHandler(_context, cluster, files, format=None,
+                                         storage=None, tokens=None, order=None,
+                                         collation=None, workers=8, processes=False):
+    """Handler of a simple ZCML directive that loads a set of data files.
+
+       The files, any of which may be a glob pattern, are matched now so
+       that the startup cache knows of each one.  At the end of configuration
+       they are all read at once, each into plain tuples, and only then merged
+       into the cluster, one after another in the order declared.
+    """
+
+    paths = []
+    directories = []
+    for pattern in files:
+        if glob.has_magic(pattern):
+            matched = sorted(glob.glob(pattern))
+            if not matched:
+                log.warning("No selector files match %r" % pattern)
+            paths.extend(matched)
+            directories.append(os.path.dirname(pattern)) # to notice files added
+        else:
+            paths.append(pattern)
+
+    selectorfiles = []
+    seen = set()
+    for path in paths:
+        if path in seen: # matched by more than one pattern
+            continue
+        seen.add(path)
+        path_format = format or guess_format(path)
+        if path_format is None:
+            raise ConfigurationError(
+                "Cannot guess the format of selector file %r, "
+                "please give a format= attribute" % path)
+        selectorfiles.append((path, path_format))
+
+    schedule_freeze(_context)
+    cache = record_sources(_context, *(paths + directories))
+    interrupt_accumulation(_context, cluster)
+
+    def deferred__load_selectorfiles(clustername, selectorfiles, storage, settings,
+                                     workers, processes, cache):
+        """The actual handling that is performed at the -END- of configuration.
+
+           Read all the data files concurrently, then merge their rows into
+           the 'cluster' object for the clustername in the order declared.
+        """
+
+        if cache is not None and cache.loaded:
+            return
+        cluster = establish_cluster(clustername, storage, **settings)
+        read = read_many_selectors(selectorfiles, workers, processes)
+        for (path, format), (mtime, selectors) in zip(selectorfiles, read):
+            try:
+                cluster.extend(selectors, path, format, mtime)
+            except ValueError as e:
+                raise ValueError("%s: %s" % (path, e))
+
+    _context.action( # register an action to occur at the end of the configuration process
+        discriminator=('selectorfiles', cluster, tuple(files)),  # must be unique!
+        callable=profiled_action(_context, cluster, deferred__load_selectorfiles),
+        args=(cluster, tuple(selectorfiles), storage,
+              dict(tokens=tokens, order=order, collation=collation),
+              workers, processes, cache),
         )
 
 
@@ -140,7 +728,9 @@ class selectorcluster_ComplexDirectiveHandler(object):
        where the name of the method *MUST* match the name of the subdirective.
     """
 
-    def __init__(self, _context, name):
+    @profiled
+    def __init__(self, _context, name, storage=None, tokens=None, order=None,
+                 collation=None, mutable=False):
         """Handle of a complex directive.
 
            Takes as arguments any attributes of the complex (outer) directive,
@@ -150,43 +740,31 @@ class selectorcluster_ComplexDirectiveHandler(object):
         self.__context = _context
         self.name = name
 
+        schedule_freeze(_context)
+        cache = record_sources(_context)
+
         _context.action( # register an action to occur at the end of the configuration process
             discriminator=('selectorcluster', name),  # must be unique!
-            callable=self.deferred__instantiate_cluster,
-            args=(_context, name),
+            callable=profiled_action(_context, name, self.deferred__instantiate_cluster),
+            args=(_context, name, storage, mutable,
+                  dict(tokens=tokens, order=order, collation=collation), cache),
             )
 
-    def deferred__instantiate_cluster(self, _context, name):
+    def deferred__instantiate_cluster(self, _context, name, storage, mutable, settings, cache):
         """The actual handling that is performed at the -END- of configuration.
 
            Create one 'cluster' object for each unique clustername seen as
            they are parsed from a ZCML file.
         """
 
-        self.cluster = queryUtility(IClusterOfSelectors, name=name)
-        if self.cluster is None: # first time this clustername has been seen
-            log.info("No such cluster as %r, creating one" % name)
-
-            self.cluster = ClusterOfSelectors(name)
-            provideUtility(self.cluster, provides=IClusterOfSelectors, name=name)
-
-            # Because of the way Zope vocabularies work, we also need a
-            # factory utility that gets called to obtain the cluster object.
-            # This use of a factory to indirectly provide the cluster is
-            # necessary because Zope wants to pass to us the context within
-            # which the vocabulary is being created.  In our case we don't
-            # -need- this context but we have to accept it anyway.  Our
-            # factory does not actually *create* a cluster object but instead
-            # just looks it up and returns it.
-
-            def SelectorFactory(context):
-                cluster = queryUtility(IClusterOfSelectors, name=name)
-                return cluster
-            alsoProvides(SelectorFactory, IVocabularyFactory)
+        if cache is not None and cache.loaded: # as cached or shared, with its settings
+            storage, settings = None, {}
+        self.cluster = establish_cluster(name, storage, **settings)
+        if mutable:
+            self.cluster.mutable = True
 
-            provideUtility(SelectorFactory, provides=IVocabularyFactory, name=name)
-
-    def selectorstring(self, _context, value, label=None):
+    @profiled
+    def selectorstring(self, _context, value, label=None, permission=None, interface=None):
         """Handler for the 'selectorstring' subdirective.
 
            Handlers for subdirectives also must AVOID executing an action
@@ -194,13 +772,19 @@ class selectorcluster_ComplexDirectiveHandler(object):
            the configuration process.
         """
 
+        cache = record_sources(_context)
+        restrict_selector(_context, self.name, value, permission, interface)
+        if _context.hasFeature(ACCUMULATE_FEATURE):
+            accumulated_selectors(_context, self.name).append((value, label))
+            return
+
         _context.action( # register an action to occur at the end of the configuration process
             discriminator=('selectorstring', self.name, value, label),  # must be unique!
-            callable=self.deferred__append_selector,
-            args=(_context, value, label),
+            callable=profiled_action(_context, self.name, self.deferred__append_selector),
+            args=(_context, value, label, cache),
             )
 
-    def deferred__append_selector(self, _context, value, label):
+    def deferred__append_selector(self, _context, value, label, cache):
         """The actual handling that is performed at the -END- of configuration.
 
            Append each selectorstring, as it is parsed from a ZCML file, onto
@@ -210,6 +794,8 @@ class selectorcluster_ComplexDirectiveHandler(object):
            The 'cluster' object represents a Zope vocabulary of a dropdown
            list with each string being a pick value on that dropdown.
         """
+        if cache is not None and cache.loaded:
+            return
         self.cluster.register(value, label)
 
     def __call__(self):
@@ -225,28 +811,207 @@ class selectorcluster_ComplexDirectiveHandler(object):
 class SelectorTerm(SimpleTerm):
     """One term or pick choice for our vocabulary of selectorstrings.
 
-       Subclassed only to provide a meaningful repr() string to make debugging
-       easier.
+       Subclassed to provide a meaningful repr() string to make debugging
+       easier, and because every such term has a title, which the clusters
+       default to the value.  So the term is declared titled once, for the
+       class, rather than by SimpleTerm for each instance, which costs far
+       more than the rest of making a term; a compact cluster makes one for
+       every string it iterates over.
     """
+    implements(ITitledTokenizedTerm)
+
+    def __init__(self, value, token=None, title=None):
+        self.value = value
+        self.title = title
+        if type(token) is not str: # as made by the clusters, needing no conversion
+            try:
+                token = token.encode('ascii') # text, made a native string
+            except (AttributeError, UnicodeError):
+                SimpleTerm.__init__(self, value, token)
+                self.title = title
+                return
+        self.token = token
 
     def __repr__(self):
         return "%s(token=%r, value=%r, title=%r)" % (
             self.__class__.__name__, self.token, self.value, self.title)
 
 
+class ClusterVersion(object):
+    """One version of the contents of a cluster.
+
+       A cluster keeps its strings in a version, which the configuration
+       process builds up and then freezes, after which it never changes again.
+       A cluster that accepts strings at runtime instead copies its version,
+       adds to the copy, freezes that and publishes it in place of the old by
+       a single assignment.  So a reader that takes hold of the version of a
+       cluster sees a consistent whole, and needs no lock to do so.
+
+       The version holds the sequences and indexes of whatever storage layout
+       the cluster uses, along with a cache of anything derived from its
+       strings, such as its search index.
+    """
+
+    def __init__(self, sequences, indexes):
+        self._sequences = sequences
+        self._indexes = indexes
+        for name in sequences:
+            setattr(self, name, [])
+        for name in indexes:
+            setattr(self, name, {})
+
+        self.predicates = {}     # (permission, interface) by value, see restrict()
+        self.derived = {}        # whatever is derived from the strings, by name
+        self.added = 0           # the strings ever added, never less for a discard
+
+    def copy(self):
+        """Return a new, unfrozen, version with the same contents.
+        """
+
+        version = ClusterVersion(self._sequences, self._indexes)
+        for name in self._sequences:
+            setattr(version, name, list(getattr(self, name)))
+        for name in self._indexes:
+            setattr(version, name, dict(getattr(self, name)))
+        version.predicates = dict(self.predicates)
+        version.added = self.added
+        return version
+
+    def freeze(self):
+        """Turn the storage into tuples.
+        """
+
+        for name in self._sequences:
+            setattr(self, name, tuple(getattr(self, name)))
+
+
+class SelectedVersion(object):
+    """A version holding only the strings at some positions of a compact version.
+
+       Its sequences and indexes are read through to those of the version it
+       selects from, so that it holds nothing but the positions selected, in
+       order, rather than a copy of their strings.  It never changes, so that
+       nothing is ever added to it.
+    """
+
+    def __init__(self, version, positions):
+        self.positions = positions
+        self.values = SelectedSequence(version.values, positions)
+        self.tokens = SelectedSequence(version.tokens, positions)
+        self.titles = SelectedSequence(version.titles, positions)
+        self.positions_by_value = SelectedIndex(version.positions_by_value, positions)
+        self.positions_by_token = SelectedIndex(version.positions_by_token, positions)
+        self.predicates = {} # those of the version selected from are already applied
+        self.derived = {}
+
+    def freeze(self):
+        pass # never anything but frozen
+
+
+class SelectedSequence(object):
+    """The items of a sequence at some positions, as a read-only sequence.
+    """
+
+    def __init__(self, sequence, positions):
+        self.sequence = sequence
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, position):
+        return self.sequence[self.positions[position]]
+
+    def __iter__(self):
+        sequence = self.sequence
+        for position in self.positions:
+            yield sequence[position]
+
+
+class SelectedIndex(object):
+    """The selected positions of the keys of an index of positions, by key.
+    """
+
+    def __init__(self, index, positions):
+        self.index = index
+        self.positions = positions
+
+    def __getitem__(self, key):
+        position = self.index[key]
+        selected = bisect_left(self.positions, position)
+        if selected == len(self.positions) or self.positions[selected] != position:
+            raise KeyError(key)
+        return selected
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
 class ClusterOfSelectors(SimpleVocabulary):
     """A iterable container of selector strings ***for a particular cluster***.
+
+       The strings are kept in a ClusterVersion, as SelectorTerm objects
+       indexed by value and by token, rather than in the attributes set up by
+       SimpleVocabulary.__init__(), which is therefore not called.  Those
+       attributes are still available, as properties, for code expecting them.
     """
     implements(IClusterOfSelectors)
 
+    storage = 'terms' # the name of the layout in CLUSTER_STORAGES
+    tokens = 'value'  # how tokens are made, see _token()
+    order = 'registration' # the order of iteration, one of ORDERS
+    collation = None  # the locale by which labels and values are ordered, if any
+    settings = ('tokens', 'order', 'collation') # those given by the directives
+    _sequences = ('terms',)
+    _indexes = ('by_value', 'by_token')
+
     def __init__(self, clustername):
-        SimpleVocabulary.__init__(self, [])
         self.clustername = clustername
+        self.frozen = False
+        self.mutable = False # whether strings may still be added once frozen
+
+        # Where the strings came from, as successive runs of them, each a
+        # (path, format, mtime, count) of the data file or, for those from
+        # ZCML, (None, None, None, count).  Used to reload changed files.
+        self.sources = []
+
+        # The problem found with each value that failed validation, should
+        # the cluster be validated and its invalid values flagged.
+        self.invalid = {}
+
+        self._version = ClusterVersion(self._sequences, self._indexes)
+        self._writing = threading.Lock() # taken by writers only, never readers
 
     def __repr__(self):
         return "%s(%r, id=%r)" % (
             self.__class__.__name__, self.clustername, id(self))
 
+    # A cluster is a named singleton that changes as strings are registered,
+    # so it compares and hashes by identity and not by its terms.
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    def __hash__(self):
+        return object.__hash__(self)
+
+    _terms = property(lambda self: self._version.terms)
+    by_value = property(lambda self: self._version.by_value)
+    by_token = property(lambda self: self._version.by_token)
+
     @classmethod
     def createTerm(cls, *args):
         return SelectorTerm(*args)
@@ -258,16 +1023,768 @@ class ClusterOfSelectors(SimpleVocabulary):
            internally.
         """
 
+        self.extend([(value, label)])
+
+    def extend(self, selectors, path=None, format=None, mtime=None):
+        """Append many selectorstrings to the cluster from (value, label) pairs.
+
+           The pairs may come from any iterable, including a generator that is
+           streaming them out of a data file.  In that case give the path and
+           format of the file, and if known the modification time at which it
+           was read, so that the cluster can later be reloaded should it change.
+
+           Once the cluster is frozen, strings may only be added to a mutable
+           cluster, and then all those given are published together as a new
+           version, or none of them if any is refused.
+        """
+
+        if path is not None and self.tokens == 'sequential':
+            raise ValueError(
+                'Cannot load the selector file %r into the cluster %r, whose '
+                'sequential tokens would change with the file; use digest tokens.'
+                % (path, self.clustername))
+        if path is not None and mtime is None:
+            mtime = os.stat(path).st_mtime
+
+        with self._writing:
+            frozen = self.frozen
+            version = self._version.copy() if frozen and self.mutable else self._version
+
+            count = 0
+            for value, label in selectors:
+                if frozen and not self.mutable:
+                    raise ValueError(
+                        'Cannot add selector (value=%r, label=%r) '
+                        'to the frozen cluster %r.' % (value, label, self.clustername))
+                self._add(version, value, label)
+                count += 1
+
+            if path is None and self.sources and self.sources[-1][0] is None:
+                count += self.sources[-1][3]
+                sources = list(self.sources[:-1])
+            else:
+                sources = list(self.sources)
+            sources.append((path, format, mtime, count))
+
+            if frozen:
+                version.freeze()
+                self.sources = tuple(sources)
+                self._version = version # publish, in a single assignment
+            else:
+                version.derived.clear()
+                self.sources = sources
+
+    def _add(self, version, value, label):
+        interning = pool.active
+        if interning: # share the strings of other clusters, see interning
+            value = pool.intern(value)
+            label = pool.intern(label)
+
         title = value if label is None else label
-        token = str(value) # a unique id used within the HTML <select>
+        token = self._token(version, value) # a unique id used within the HTML <select>
+        if interning:
+            token = pool.intern(token)
+
+        self._append(version, value, token, title)
+        version.added += 1
+
+    def _readd(self, version, term):
+        """Store a term of another version in a version.
+        """
+        self._append(version, term.value, term.token, term.title)
 
-        term = self.createTerm(value, token, title)
+    def _token(self, version, value):
+        """Return the token for a value, as made by the tokens of the cluster.
 
-        self._terms.append(term)
-        self.by_value[term.value] = term
-        self.by_token[term.token] = term
+           'value' tokens are the value itself, which for long values, such as
+           paths, bloats the HTML of every page with a <select> of them.  Any
+           non-ASCII characters of a text value are escaped, as by SimpleTerm.
 
-        if len(self.by_value) != len(self.by_token) != len(self._terms):
+           'digest' tokens are the first 8 characters of the base32 SHA-1 of
+           the value, lengthened, should that collide within the cluster, to
+           16 and then all 32 characters.  They are stable across restarts.
+
+           'sequential' tokens are the count of strings added before it, in
+           hex, and so are stable across restarts only while strings are only
+           appended.  Those of discarded strings are never made again.  Since
+           a data file may change in any way, and a reload of it renumbers its
+           strings, a cluster with sequential tokens refuses data files.
+        """
+
+        if self.tokens == 'digest':
+            text = value if isinstance(value, bytes) else (u'%s' % value).encode('utf-8')
+            digest = b32encode(sha1(text).digest()).lower()
+            for length in (8, 16):
+                if not self._hasToken(version, digest[:length]):
+                    return digest[:length]
+            return digest
+
+        if self.tokens == 'sequential':
+            return '%x' % version.added
+
+        if isinstance(value, text_type):
+            return value.encode('ascii', 'backslashreplace')
+        return str(value)
+
+    def _hasToken(self, version, token):
+        return token in version.by_token
+
+    def _append(self, version, value, token, title):
+        """Store one term in a version, in whatever layout the class uses.
+
+           Returns the position of the term.
+        """
+
+        if value in version.by_value or token in version.by_token:
+            raise ValueError(
+                'Adding selector (value=%r, title=%r) '
+                'resulted in a duplicate entry.' % (value, title))
+
+        if pool.active:
+            term = pool.term(type(self), value, token, title)
+        else:
+            term = self.createTerm(value, token, title)
+
+        version.terms.append(term)
+        version.by_value[term.value] = term
+        version.by_token[term.token] = term
+        return len(version.terms) - 1
+
+    def _term(self, position, version=None):
+        if version is None:
+            version = self._version
+        return version.terms[position]
+
+    def _iter(self, version):
+        return iter(version.terms)
+
+    def __iter__(self):
+        return self._iterOrdered(self._version)
+
+    def __len__(self):
+        return len(self._version.terms)
+
+    def __contains__(self, value):
+        try:
+            return value in self._version.by_value
+        except TypeError: # unhashable values are never in the cluster
+            return False
+
+    def getTerm(self, value):
+        try:
+            return self._version.by_value[value]
+        except KeyError:
+            raise LookupError(value)
+
+    def getTermByToken(self, token):
+        try:
+            return self._version.by_token[token]
+        except KeyError:
+            raise LookupError(token)
+
+    def getTermsByTokens(self, tokens):
+        """Return the terms of many tokens, such as submitted by a multi-select.
+
+           The terms of the distinct tokens are returned in the order given.
+           If any token is unknown, a single LookupError of them all is raised.
+        """
+
+        found, missing = self.partition(tokens)
+        if missing:
+            raise LookupError(*missing)
+        return found
+
+    def containsAll(self, values):
+        """Return whether every one of many values is in the cluster.
+        """
+
+        index = self._valueIndex(self._version)
+        try:
+            for value in set(values):
+                if value not in index:
+                    return False
+        except TypeError: # unhashable values are never in the cluster
+            return False
+        return True
+
+    def partition(self, tokens):
+        """Return the (terms found, tokens missing) of many tokens.
+
+           Each is in the order given, with any repeated token taken but once.
+           All are looked up in the same version of the cluster, in one pass
+           over the tokens and never over the cluster.
+        """
+
+        version = self._version
+        found = []
+        missing = []
+        seen = set()
+        for token in tokens:
+            if token in seen:
+                continue
+            seen.add(token)
+            term = self._termByToken(version, token)
+            if term is None:
+                missing.append(token)
+            else:
+                found.append(term)
+        return found, missing
+
+    def _valueIndex(self, version):
+        return version.by_value
+
+    def _termByToken(self, version, token):
+        return version.by_token.get(token)
+
+    def slice(self, start, stop):
+        """Return the terms from position start up to, but not including, stop.
+
+           Only the terms asked for are visited, so that a client paging
+           through a large cluster pays for each page and not for all those
+           before it.
+        """
+
+        version = self._version
+        view = self._view(version)
+        if view is None:
+            return self._slice(version, start, stop)
+        return [self._term(position, version) for position in view[start:stop]]
+
+    def page(self, n, size):
+        """Return page n, counting from 0, of the terms when split into pages of a size.
+        """
+
+        return self.slice(n * size, (n + 1) * size)
+
+    def pageAfter(self, token, size):
+        """Return a page of the terms following the term having a token.
+
+           This lets a client continue from the last term it was given, as a
+           cursor, whatever strings may have been added since.  A LookupError
+           is raised for an unknown token.
+        """
+
+        version = self._version
+        try:
+            position = self._position_by_token(version, token)
+        except KeyError:
+            raise LookupError(token)
+
+        view = self._view(version)
+        if view is None:
+            return self._slice(version, position + 1, position + 1 + size)
+
+        key = ('ordered-index', self.order, self.collation)
+        index = version.derived.get(key)
+        if index is None: # built once for each version that is paged
+            index = version.derived[key] = dict(
+                (position, i) for i, position in enumerate(view))
+        start = index[position] + 1
+        return [self._term(position, version) for position in view[start:start + size]]
+
+    def _slice(self, version, start, stop):
+        return list(version.terms[start:stop])
+
+    def _position_by_token(self, version, token):
+        positions = version.derived.get('positions_by_token')
+        if positions is None: # built once for each version that is paged
+            positions = version.derived['positions_by_token'] = dict(
+                (term.token, position) for position, term in enumerate(version.terms))
+        return positions[token]
+
+    def restrict(self, value, permission=None, interface=None):
+        """Show the selectorstring of a value only in some contexts.
+
+           Only a context providing the interface, and in which the permission
+           is granted, sees the selectorstring in the cluster returned for it
+           by filtered().  Once frozen, only a mutable cluster may be restricted.
+        """
+
+        with self._writing:
+            frozen = self.frozen
+            if frozen and not self.mutable:
+                raise ValueError('Cannot restrict the selector (value=%r) of the '
+                                 'frozen cluster %r.' % (value, self.clustername))
+            version = self._version.copy() if frozen else self._version
+            if value not in self._valueIndex(version):
+                raise LookupError(value)
+
+            version.predicates[value] = (permission, interface)
+            if frozen:
+                version.freeze()
+                self._version = version # publish, in a single assignment
+            else:
+                version.derived.clear()
+
+    def discard(self, values):
+        """Remove the selectorstrings of some values from the cluster.
+
+           The remaining terms keep their tokens and order, and the runs of
+           strings recorded in the sources of the cluster are shortened to
+           match, so that it may still be reloaded.  Returns the number of
+           selectorstrings removed.
+        """
+
+        values = set(values)
+        with self._writing:
+            frozen = self.frozen
+            if frozen and not self.mutable:
+                raise ValueError('Cannot discard selectors from the frozen cluster %r.'
+                                 % self.clustername)
+            old = self._version
+            version = ClusterVersion(self._sequences, self._indexes)
+            version.added = old.added
+            version.predicates = dict((value, predicate)
+                                      for value, predicate in old.predicates.items()
+                                      if value not in values)
+
+            terms = self._iter(old)
+            sources = []
+            removed = 0
+            for path, format, mtime, count in self.sources:
+                kept = 0
+                for i in range(count):
+                    term = next(terms)
+                    if term.value in values:
+                        removed += 1
+                    else:
+                        self._readd(version, term)
+                        kept += 1
+                sources.append((path, format, mtime, kept))
+
+            if frozen:
+                version.freeze()
+                self.sources = tuple(sources)
+            else:
+                self.sources = sources
+            self._version = version # publish, in a single assignment
+            return removed
+
+    def flag(self, problems):
+        """Flag some values as invalid, given the problem found with each.
+
+           Flagged values are kept in the cluster, so that one already chosen
+           is still shown, but renderOptions() offers them disabled.  Other
+           callers find the problems in the 'invalid' dictionary.
+        """
+
+        with self._writing:
+            self.invalid.update(problems)
+            derived = self._version.derived
+            derived.pop('options', None) # as are those of the filtered views
+            derived.pop('filtered', None)
+
+    filtered_cache_size = 32 # the filtered views kept for each version
+
+    def filtered(self, context):
+        """Return the cluster as seen from a context, without what it may not see.
+
+           Contexts are told apart only by which of the distinct predicates of
+           the cluster they satisfy, and the filtered view for each such
+           outcome is kept, with the version of the cluster, in a bounded LRU
+           cache.  A cluster with no restricted strings returns itself.
+
+           Only the vocabulary factory filters the cluster; the methods of the
+           cluster itself, such as renderOptions(), search() and page(), see
+           every selectorstring, as do those of the views only their own.
+        """
+
+        version = self._version
+        if not version.predicates:
+            return self
+
+        predicates = version.derived.get('predicates')
+        if predicates is None:
+            predicates = version.derived['predicates'] = tuple(
+                sorted(set(version.predicates.values()), key=repr))
+        signature = tuple(context_allows(context, permission, interface)
+                          for permission, interface in predicates)
+
+        views = version.derived.get('filtered')
+        if views is None:
+            views = version.derived.setdefault('filtered', LRUCache(self.filtered_cache_size))
+        view = views.get(signature)
+        if view is None:
+            allowed = dict(zip(predicates, signature))
+            view = views.put(signature, self._filteredView(version, allowed))
+        return view
+
+    def _filteredView(self, version, allowed):
+        """Return a frozen cluster of the terms whose predicates are allowed.
+
+           The view holds the very same terms, rather than copies of them, and
+           is listed in the same order.
+        """
+
+        view = ClusterOfSelectors(self.clustername)
+        for name in self.settings:
+            setattr(view, name, getattr(self, name))
+        view.invalid = self.invalid
+
+        into = view._version
+        for term in self._iter(version):
+            predicate = version.predicates.get(term.value)
+            if predicate is not None and not allowed[predicate]:
+                continue
+            view._readd(into, term)
+
+        view.freeze()
+        return view
+
+    def ordered(self, order=None, collation=None):
+        """Return the terms in an order, by default the order declared for the cluster.
+
+           The order is one of ORDERS, that is 'registration', 'label' or
+           'value', and the collation names any locale by whose rules the
+           labels or values are to be compared.
+        """
+
+        return list(self._iterOrdered(self._version, order, collation))
+
+    def _iterOrdered(self, version, order=None, collation=None):
+        view = self._view(version, order, collation)
+        if view is None:
+            return self._iter(version)
+        return (self._term(position, version) for position in view)
+
+    def _view(self, version, order=None, collation=None):
+        """Return the positions of the terms of a version in an order, or None.
+
+           None is returned for the order of registration, which is that of
+           the storage itself.  Any other order is sorted only once for each
+           version, the first time it is wanted, and kept with the version.
+        """
+
+        order = order or self.order
+        if order == 'registration':
+            return None
+        if order not in ORDERS:
+            raise ValueError("Unknown order %r of cluster %r" % (order, self.clustername))
+        if collation is None:
+            collation = self.collation
+
+        key = ('ordered', order, collation)
+        view = version.derived.get(key)
+        if view is None:
+            if order == 'label':
+                text = lambda term: label_text(term.title)
+            else:
+                text = lambda term: term.value
+            if collation:
+                text_key = collation_key(collation)
+                sort_key = lambda term: text_key(u'%s' % text(term))
+            else:
+                sort_key = text
+
+            keyed = sorted((sort_key(term), position)
+                           for position, term in enumerate(self._iter(version)))
+            view = version.derived[key] = tuple(position for text, position in keyed)
+        return view
+
+    def translated(self, request=None, language=None, sort=False):
+        """Return the terms of the cluster, with their labels translated, as a tuple.
+
+           The language is that given or else the one negotiated for the
+           request.  The terms are in the order of the cluster or, if sort is
+           true, in that of their translated labels, collated for the locale
+           of the cluster or else for the language.  They are built only the
+           first time they are wanted for each language, and kept with the
+           version of the cluster; a term whose label is not an i18n message
+           id is the very term of the cluster.
+        """
+
+        version = self._version
+        if language is None and request is not None and negotiate is not None:
+            language = negotiate(request)
+
+        key = ('translated', language, bool(sort))
+        terms = version.derived.get(key)
+        if terms is None:
+            terms = version.derived[key] = self._translated(version, language, sort)
+        return terms
+
+    def _translated(self, version, language, sort):
+        terms = []
+        for term in self._iterOrdered(version):
+            title = term.title
+            if isinstance(title, Message):
+                if translate is not None:
+                    text = translate(title, target_language=language)
+                else:
+                    text = u'%s' % label_text(title)
+                term = self.createTerm(term.value, term.token, text)
+            terms.append(term)
+
+        if sort:
+            collation = self.collation or language
+            if collation:
+                text_key = collation_key(collation)
+                terms.sort(key=lambda term: text_key(u'%s' % term.title))
+            else:
+                terms.sort(key=lambda term: term.title)
+        return tuple(terms)
+
+    def freeze(self):
+        """Make the cluster immutable, and read-optimised, now it is complete.
+
+           This is done for every cluster at the end of configuration, after
+           which any further register() is refused unless the cluster is
+           mutable.  The storage is turned into tuples, so that no reader
+           could ever see it change.
+        """
+
+        with self._writing:
+            if self.frozen:
+                return
+            self._version.freeze()
+            self.sources = tuple(self.sources)
+            self.frozen = True
+
+    def renderOptions(self, selected=()):
+        """Return the HTML <option> elements of the cluster, for use in a <select>.
+
+           The options with the given values are marked as selected, and
+           those of values flagged as invalid are disabled.  Labels
+           that are i18n message ids are shown untranslated, as their default
+           text; translated() gives the terms with their labels translated.
+
+           The markup, with every token and title escaped, is built once and
+           kept until a string is next registered.  Also kept is the offset
+           within it at which each option may be marked selected, so that
+           doing so is merely a splice rather than rendering anything again.
+        """
+
+        version = self._version
+        options = version.derived.get('options')
+        if options is None:
+            options = version.derived['options'] = self._renderOptions(version)
+        markup, offsets = options
+
+        splices = []
+        for value in selected:
+            try:
+                offset = offsets.get(value)
+            except TypeError: # an unhashable value is never an option
+                continue
+            if offset is not None:
+                splices.append(offset)
+        if not splices:
+            return markup
+        splices = sorted(set(splices)) # a value given twice is selected once
+
+        pieces = []
+        start = 0
+        for offset in splices:
+            pieces.append(markup[start:offset])
+            pieces.append(u' selected="selected"')
+            start = offset
+        pieces.append(markup[start:])
+        return u''.join(pieces)
+
+    def _renderOptions(self, version):
+        invalid = self.invalid
+        pieces = []
+        offsets = {}
+        length = 0
+        for term in self._iterOrdered(version):
+            offsets[term.value] = length + len(u'<option')
+            piece = u'<option value="%s"%s>%s</option>\n' % (
+                escape(term.token, QUOTE_ENTITIES),
+                u' disabled="disabled"' if term.value in invalid else u'',
+                escape(label_text(term.title)))
+            pieces.append(piece)
+            length += len(piece)
+        return u''.join(pieces), offsets
+
+    def search(self, prefix, limit=10):
+        """Return up to limit terms whose value or label starts with a prefix.
+
+           Case is ignored and the terms are ordered by the text that matched.
+           This is meant for typeahead pickers over clusters too large for a
+           dropdown, so rather than scan every term it bisects a sorted index.
+           The index is built by the first search of each version, since most
+           clusters are never searched at all, and kept with the version.
+        """
+
+        version = self._version
+        index = version.derived.get('search')
+        if index is None:
+            index = version.derived['search'] = self._searchIndex(version)
+
+        prefix = prefix.lower()
+        terms = []
+        seen = set()
+        i = bisect_left(index, (prefix,))
+        while i < len(index) and len(terms) < limit:
+            key, position = index[i]
+            if not key.startswith(prefix):
+                break
+            if position not in seen: # both value and label may match
+                seen.add(position)
+                terms.append(self._term(position, version))
+            i += 1
+        return terms
+
+    def _searchIndex(self, version):
+        """Return the sorted (folded text, position) of every value and label.
+        """
+
+        index = []
+        for position, (value, title) in enumerate(self._strings(version)):
+            title = label_text(title)
+            for text in (value,) if title == value else (value, title):
+                key = text.lower()
+                index.append((text if key == text else key, position))
+        return tuple(sorted(index))
+
+    def _strings(self, version):
+        return ((term.value, term.title) for term in self._iter(version))
+
+
+class CompactClusterOfSelectors(ClusterOfSelectors):
+    """A cluster of selector strings stored compactly, for very large clusters.
+
+       Rather than a SelectorTerm object per selectorstring, indexed from
+       three places, the values, tokens and titles are kept in parallel lists
+       and only the positions within them are indexed.  Where a token or title
+       is equal to its value, the value object itself is stored in its place.
+
+       SelectorTerm objects are created only when asked for, and a bounded
+       number of those handed out by getTerm() and getTermByToken() are
+       cached for reuse, by position, with the version whose positions they
+       are.  Those made while iterating are not cached.
+    """
+
+    storage = 'compact'
+    _sequences = ('values', 'tokens', 'titles')
+    _indexes = ('positions_by_value', 'positions_by_token')
+
+    term_cache_size = 1000
+
+    def _append(self, version, value, token, title):
+        """Store one term in a version as an entry in each parallel list.
+        """
+
+        if value in version.positions_by_value or token in version.positions_by_token:
             raise ValueError(
-                'Adding selector (value=%r, label=%r) '
-                'resulted in a duplicate entry.' % (value, label))
+                'Adding selector (value=%r, title=%r) '
+                'resulted in a duplicate entry.' % (value, title))
+
+        if token == value:
+            token = value
+        if title == value and type(title) is type(value): # not an equal message id
+            title = value
+
+        position = len(version.values)
+        version.values.append(value)
+        version.tokens.append(token)
+        version.titles.append(title)
+        version.positions_by_value[value] = position
+        version.positions_by_token[token] = position
+        return position
+
+    def _term(self, position, version=None):
+        if version is None:
+            version = self._version
+        return self.createTerm(
+            version.values[position], version.tokens[position], version.titles[position])
+
+    def _cached_term(self, version, position):
+        # Cached with the version, as discard() renumbers the positions.
+        cache = version.derived.get('terms')
+        if cache is None:
+            cache = version.derived.setdefault('terms', {})
+        term = cache.get(position)
+        if term is None:
+            if len(cache) >= self.term_cache_size:
+                try:
+                    cache.popitem() # evict any one to stay bounded
+                except KeyError:
+                    pass # emptied meanwhile by another thread
+            term = cache[position] = self._term(position, version)
+        return term
+
+    def _iter(self, version):
+        createTerm = self.createTerm
+        values, tokens, titles = version.values, version.tokens, version.titles
+        for position in range(len(values)):
+            yield createTerm(values[position], tokens[position], titles[position])
+
+    def _strings(self, version):
+        return zip(version.values, version.titles)
+
+    def _slice(self, version, start, stop):
+        positions = range(*slice(start, stop).indices(len(version.values)))
+        return [self._term(position, version) for position in positions]
+
+    def _position_by_token(self, version, token):
+        return version.positions_by_token[token]
+
+    def _hasToken(self, version, token):
+        return token in version.positions_by_token
+
+    def __len__(self):
+        return len(self._version.values)
+
+    def __contains__(self, value):
+        try:
+            return value in self._version.positions_by_value
+        except TypeError: # unhashable values are never in the cluster
+            return False
+
+    def getTerm(self, value):
+        version = self._version
+        try:
+            return self._cached_term(version, version.positions_by_value[value])
+        except KeyError:
+            raise LookupError(value)
+
+    def getTermByToken(self, token):
+        version = self._version
+        try:
+            return self._cached_term(version, version.positions_by_token[token])
+        except KeyError:
+            raise LookupError(token)
+
+    def _valueIndex(self, version):
+        return version.positions_by_value
+
+    def _termByToken(self, version, token):
+        position = version.positions_by_token.get(token)
+        if position is None:
+            return None
+        return self._term(position, version)
+
+    def _filteredView(self, version, allowed):
+        """Return a frozen cluster of the strings whose predicates are allowed.
+
+           As terms are made on demand in this layout, the view holds neither
+           terms nor strings, but only the positions of those it shows, through
+           which it reads the strings of this version.
+        """
+
+        hidden = set(version.positions_by_value[value]
+                     for value, predicate in version.predicates.items()
+                     if not allowed[predicate])
+        positions = array('l', (position for position in range(len(version.values))
+                                if position not in hidden))
+
+        view = CompactClusterOfSelectors(self.clustername)
+        for name in self.settings:
+            setattr(view, name, getattr(self, name))
+        view.invalid = self.invalid
+        view._version = SelectedVersion(version, positions)
+        view.frozen = True
+        return view
+
+
+####
+# The storage layouts a cluster may be declared to use, by the storage=
+# attribute of the <selectorcluster> and <selectorfile> directives.
+
+ORDERS = ('registration', 'label', 'value')
+
+CLUSTER_STORAGES = {
+    'terms': ClusterOfSelectors,
+    'compact': CompactClusterOfSelectors,
+    }